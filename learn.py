@@ -1,9 +1,15 @@
 import argparse
 import datetime
 import os
+import sys
 import time
 
-from scripts.utils import print_with_color
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import document_generation
+import self_explorer
+import step_recorder
+from utils import print_with_color
 
 arg_desc = "AppAgent - exploration phase"
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
@@ -36,9 +42,9 @@ if not app:
     app = app.replace(" ", "")
 
 if user_input == "1":
-    os.system(f"python scripts/self_explorer.py --app {app} --root_dir {root_dir}")
+    self_explorer.main(app, root_dir)
 else:
     demo_timestamp = int(time.time())
     demo_name = datetime.datetime.fromtimestamp(demo_timestamp).strftime(f"demo_{app}_%Y-%m-%d_%H-%M-%S")
-    os.system(f"python scripts/step_recorder.py --app {app} --demo {demo_name} --root_dir {root_dir}")
-    os.system(f"python scripts/document_generation.py --app {app} --demo {demo_name} --root_dir {root_dir}")
+    if step_recorder.main(app, demo_name, root_dir):
+        document_generation.main(app, demo_name, root_dir)
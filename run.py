@@ -1,7 +1,11 @@
 import argparse
 import os
+import sys
 
-from scripts.utils import print_with_color
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import task_executor
+from utils import print_with_color
 
 arg_desc = "AppAgent - deployment phase"
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
@@ -22,4 +26,4 @@ if not app:
     app = input()
     app = app.replace(" ", "")
 
-os.system(f"python scripts/task_executor.py --app {app} --root_dir {root_dir}")
+task_executor.main(app, root_dir)
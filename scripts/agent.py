@@ -0,0 +1,973 @@
+import datetime
+import functools
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+import prompts
+from config import load_config
+from doc_store import DocStore
+from and_controller import extract_elements, frame_fingerprint
+from model import ask_gpt4v, get_client, parse_explore_rsp, parse_grid_rsp, parse_reflect_rsp
+from response_cache import get_response_cache
+from screen_graph import CHANGE_NONE, GRAPH_ACTIONS, classify_change, get_screen_graph, perform_action, \
+    screen_signature
+from speculation import Speculator, print_speculation_stats
+from tracing import Tracer, bind, span
+from usage import BUDGET_DEGRADE, BUDGET_EXCEEDED, UsageLedger, app_usage
+from utils import print_with_color, draw_bbox_multi, fit_image, get_grid_layout, load_image, prepare_image
+
+configs = load_config()
+
+# The error of a task that ended because the device could not be read, which says more about the device than the task.
+PERCEPTION_FAILED = "failed to capture the screen"
+
+
+def find_docs_dir(app_dir, docs=None):
+    """Pick the doc base of an app without asking: "auto", "demo", "none" or None to prefer auto_docs over demo_docs.
+    Returns None when no docs should be used."""
+    auto_docs_dir = os.path.join(app_dir, "auto_docs")
+    demo_docs_dir = os.path.join(app_dir, "demo_docs")
+    if docs == "none":
+        return None
+    if docs == "auto":
+        return auto_docs_dir if os.path.exists(auto_docs_dir) else None
+    if docs == "demo":
+        return demo_docs_dir if os.path.exists(demo_docs_dir) else None
+    if os.path.exists(auto_docs_dir):
+        return auto_docs_dir
+    if os.path.exists(demo_docs_dir):
+        return demo_docs_dir
+    return None
+
+
+def make_run_dir(parent_dir, name):
+    """Create a uniquely named directory, adding a counter when several runs start within the same second."""
+    run_dir = os.path.join(parent_dir, name)
+    count = 1
+    while True:
+        try:
+            os.mkdir(run_dir)
+            return run_dir
+        except FileExistsError:
+            count += 1
+            run_dir = os.path.join(parent_dir, f"{name}_{count}")
+
+
+def finish_trace(tracer, result):
+    """Print the latency summary of a run, attach it to the run's result and export the trace if configured."""
+    tracer.print_summary()
+    result["phases"] = tracer.summary()
+    if configs["TRACE_EXPORT"]:
+        trace_path = os.path.join(result["task_dir"], "trace.json")
+        tracer.export_chrome(trace_path)
+        print_with_color(f"Trace saved to {trace_path}", "yellow")
+
+
+def report_usage(usage, app_dir):
+    totals = app_usage(app_dir)
+    print_with_color(f"{usage['calls']} model calls used {usage['prompt_tokens']} prompt tokens (about "
+                     f"{usage['image_tokens']} for images) and {usage['completion_tokens']} completion tokens, costing "
+                     f"${usage['cost']:.2f}. {totals['tasks']} runs in this app have cost ${totals['cost']:.2f} so "
+                     f"far.", "yellow")
+    cache = get_response_cache()
+    if cache is not None:
+        print_cache_stats(cache.stats())
+
+
+def print_cache_stats(stats):
+    print_with_color(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit "
+                     f"rate), {stats['evictions']} evictions, ${stats['saved_cost']:.2f} saved", "yellow")
+
+
+class Agent:
+    """The deployment-phase agent: completes tasks in one app on one device, guided by the app's doc base.
+
+    An Agent can run any number of tasks in a row; the doc base is loaded once and the controller, model client and
+    rate limiter are reused across tasks.
+    """
+
+    def __init__(self, app, controller, docs_dir=None, root_dir="./", client=None):
+        self.app = app
+        self.controller = controller
+        self.docs_dir = docs_dir
+        self.doc_store = DocStore(docs_dir) if docs_dir else None
+        self.client = client or get_client()
+        self.width, self.height = controller.width, controller.height
+        self.app_dir = os.path.join(root_dir, "apps", app)
+        self.work_dir = os.path.join(root_dir, "tasks")
+        if not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+        if self.doc_store is not None:
+            print_with_color(f"{len(self.doc_store)} documented UI elements loaded from {docs_dir}", "yellow")
+        self.graph = get_screen_graph(self.app_dir)
+        # Labels, encodes and saves screenshots off the round loop when perception is pipelined.
+        self.pipeline = ThreadPoolExecutor(max_workers=2, thread_name_prefix="perception") \
+            if configs["PIPELINED_PERCEPTION"] else None
+        self.pending_writes = []
+        self.speculator = None
+        if configs["SPECULATIVE_PREWARM"] and self.graph is not None:
+            self.speculator = Speculator(self.graph, self.doc_store, self.build_ui_doc, configs["SPECULATION_TOP_K"])
+
+    def area_to_xy(self, area, subarea, grid):
+        """The device coordinates of a subarea of a cell of the grid drawn on the last screenshot."""
+        x, y = grid.point(area, subarea)
+        if (grid.width, grid.height) != (self.width, self.height):
+            x, y = x * self.width // grid.width, y * self.height // grid.height
+        return x, y
+
+    def save_image(self, image, path):
+        if self.pipeline is None:
+            cv2.imwrite(path, image)
+        else:
+            self.pending_writes.append(self.pipeline.submit(bind(cv2.imwrite), path, image))
+
+    def render_screenshot(self, image, max_edge, output_path, elem_list=None, grid=None):
+        """Label a screenshot with the grid, or with the tags of the elements, and encode it for upload. The labeled
+        image is saved to output_path. Returns the data URL and the payload stats of the encoded image."""
+        if grid is not None:
+            with span("draw_grid"):
+                labeled_img = grid.draw(image)
+                self.save_image(labeled_img, output_path)
+                labeled_img, _ = fit_image(labeled_img, max_edge)
+        else:
+            with span("draw_bbox_multi"):
+                image, scale = fit_image(image, max_edge)
+                labeled_img = draw_bbox_multi(image, None, elem_list, dark_mode=configs["DARK_MODE"], scale=scale)
+                self.save_image(labeled_img, output_path)
+        with span("prepare_image"):
+            return prepare_image(labeled_img, configs["IMAGE_FORMAT"], configs["IMAGE_QUALITY"],
+                                 configs["IMAGE_GRAYSCALE"])
+
+    def build_ui_doc(self, uids):
+        ui_doc = """
+        You also have access to the following documentations that describes the functionalities of UI
+        elements you can interact on the screen. These docs are crucial for you to determine the target of your
+        next action. You should always prioritize these documented elements for interaction:"""
+        self.doc_store.refresh()
+        for i, uid in enumerate(uids):
+            doc_content = self.doc_store.get(uid)
+            if doc_content is None:
+                continue
+            ui_doc += f"Documentation of UI element labeled with the numeric tag '{i + 1}':\n"
+            if doc_content["tap"]:
+                ui_doc += f"This UI element is clickable. {doc_content['tap']}\n\n"
+            if doc_content["text"]:
+                ui_doc += f"This UI element can receive text input. The text input is used for the following " \
+                          f"purposes: {doc_content['text']}\n\n"
+            if doc_content["long_press"]:
+                ui_doc += f"This UI element is long clickable. {doc_content['long_press']}\n\n"
+            if doc_content["v_swipe"]:
+                ui_doc += f"This element can be swiped directly without tapping. You can swipe vertically on " \
+                          f"this UI element. {doc_content['v_swipe']}\n\n"
+            if doc_content["h_swipe"]:
+                ui_doc += f"This element can be swiped directly without tapping. You can swipe horizontally on " \
+                          f"this UI element. {doc_content['h_swipe']}\n\n"
+        return ui_doc
+
+    def replay_known_path(self, task_desc, task_dir, dir_name, log_path):
+        """Replay the actions of the navigation prefix of a task completed before, when the task starts on the screen
+        it started on then, checking every screen on the way. Stops before an action that has not always led to the
+        same screen and at the first screen that is not the expected one, recording where the action led. Returns the
+        hops replayed and the summary of the last one."""
+        route = self.graph.route(task_desc)
+        if route is None:
+            return [], "None"
+        ui_tree = self.controller.dump_hierarchy(f"{dir_name}_0", task_dir)
+        if ui_tree == "ERROR":
+            return [], "None"
+        screen = screen_signature(ui_tree)
+        if screen != route["start"]:
+            return [], "None"
+        print_with_color(f"Replaying a known path of {len(route['steps'])} steps", "yellow")
+        hops = []
+        last_act = "None"
+        for step in route["steps"]:
+            action, expected, summary = step["action"], step["screen"], step["summary"]
+            if not self.graph.is_deterministic(screen, action, expected):
+                print_with_color(f"{action['name']} on {action['uid']} has not always led to the same screen, "
+                                 f"handing over to the model", "yellow")
+                break
+            ret = perform_action(self.controller, action, extract_elements(ui_tree))
+            if ret == "ERROR":
+                break
+            self.controller.wait_until_settled()
+            ui_tree = self.controller.dump_hierarchy(f"{dir_name}_0", task_dir)
+            if ui_tree == "ERROR":
+                break
+            next_screen = screen_signature(ui_tree)
+            hops.append({"src": screen, "action": action, "dst": next_screen, "summary": summary})
+            self.graph.visit(next_screen)
+            self.graph.add_transition(screen, action, next_screen, summary)
+            if next_screen != expected:
+                print_with_color(f"The screen after {action['name']} on {action['uid']} is not the known one, handing "
+                                 f"over to the model", "yellow")
+                break
+            screen = next_screen
+            last_act = summary or last_act
+        with open(log_path, "a") as logfile:
+            logfile.write(json.dumps({"step": 0, "replayed": hops}) + "\n")
+        print_with_color(f"{len(hops)} steps replayed without the model", "yellow")
+        return hops, last_act
+
+    def run(self, task_desc, max_rounds=None):
+        """Run one task to completion. Returns a summary with the outcome, the number of rounds, the task dir, the
+        time spent on perception, the model and actions, the tokens and cost and the p50/p95 latency of every phase.
+
+        The task runs in a cheaper mode, with smaller screenshots and no docs, once it nears its budget and is aborted
+        with the status "budget" when the budget is used up. With REPLAY_KNOWN_PATHS, the recorded navigation of a task
+        completed before is replayed first, and the model takes over where it ends. With SPECULATIVE_PREWARM, the
+        result also holds the hit rates of the speculation that prewarms each round during the model call of the one
+        before."""
+        tracer = Tracer(f"{self.app}: {task_desc}")
+        with tracer.activate():
+            result = self._run(task_desc, max_rounds or configs["MAX_ROUNDS"], tracer)
+        finish_trace(tracer, result)
+        return result
+
+    def _run(self, task_desc, max_rounds, tracer):
+        controller = self.controller
+        start_time = time.time()
+        dir_name = datetime.datetime.fromtimestamp(int(start_time)).strftime(f"task_{self.app}_%Y-%m-%d_%H-%M-%S")
+        task_dir = make_run_dir(self.work_dir, dir_name)
+        dir_name = os.path.basename(task_dir)
+        log_path = os.path.join(task_dir, f"log_{self.app}_{dir_name}.txt")
+
+        round_count = 0
+        last_act = "None"
+        task_complete = False
+        grid_on = False
+        grid = None
+        latency = {"perception": 0.0, "model": 0.0, "action": 0.0}
+        ledger = UsageLedger()
+        over_budget = False
+        perception_failed = False
+        hops = []
+        pending = None
+        if self.graph is not None and configs["REPLAY_KNOWN_PATHS"]:
+            with span("replay_known_path"):
+                hops, last_act = self.replay_known_path(task_desc, task_dir, dir_name, log_path)
+        replayed = len(hops)
+        if self.speculator is not None:
+            self.speculator.reset()
+        while round_count < max_rounds:
+            tracer.flush(log_path, round_count)
+            budget = ledger.check_budget()
+            if budget == BUDGET_EXCEEDED:
+                over_budget = True
+                break
+            max_edge = configs["BUDGET_IMAGE_MAX_EDGE"] if budget == BUDGET_DEGRADE else configs["IMAGE_MAX_EDGE"]
+            round_count += 1
+            print_with_color(f"Round {round_count}", "yellow")
+            step_start = time.time()
+            screenshot, ui_tree = controller.perceive(f"{dir_name}_{round_count}", task_dir)
+            if screenshot == "ERROR" or ui_tree == "ERROR":
+                perception_failed = True
+                break
+            if grid_on:
+                grid = get_grid_layout(screenshot.image.shape[1], screenshot.image.shape[0])
+                render = functools.partial(self.render_screenshot, screenshot.image, max_edge,
+                                           os.path.join(task_dir, f"{dir_name}_{round_count}_grid.png"), grid=grid)
+            else:
+                with span("extract_elements"):
+                    elem_list = extract_elements(ui_tree)
+                render = functools.partial(self.render_screenshot, screenshot.image, max_edge,
+                                           os.path.join(task_dir, f"{dir_name}_{round_count}_labeled.png"),
+                                           elem_list=elem_list)
+            # The screenshot is labeled and encoded on a worker while the screen is fingerprinted and the docs of its
+            # elements are retrieved.
+            rendered = self.pipeline.submit(bind(render)) if self.pipeline is not None else None
+            if configs["LOG_UI_XML"]:
+                ui_tree.save()
+            with span("screen_signature"):
+                screen = screen_signature(ui_tree)
+            if self.graph is not None:
+                self.graph.visit(screen, None if grid_on else elem_list.uids())
+                if pending is not None:
+                    src, action, summary = pending
+                    if action is not None:
+                        self.graph.add_transition(src, action, screen, summary)
+                    hops.append({"src": src, "action": action, "dst": screen, "summary": summary})
+                    pending = None
+            ui_doc = None
+            if grid_on:
+                prompt = prompts.task_template_grid
+            else:
+                if self.doc_store is None or budget == BUDGET_DEGRADE:
+                    prompt = re.sub(r"<ui_document>", "", prompts.task_template)
+                else:
+                    with span("build_ui_doc"):
+                        if self.speculator is not None:
+                            ui_doc = self.speculator.ui_doc(screen, elem_list.uids())
+                        if ui_doc is None:
+                            ui_doc = self.build_ui_doc(elem_list.uids())
+                    print_with_color(f"Documentations retrieved for the current interface:\n{ui_doc}", "magenta")
+                    prompt = re.sub(r"<ui_document>", ui_doc, prompts.task_template)
+            prompt = re.sub(r"<task_description>", task_desc, prompt)
+            prompt = re.sub(r"<last_act>", last_act, prompt)
+            image_url, image_stats = rendered.result() if rendered is not None else render()
+            latency["perception"] += time.time() - step_start
+            content = [
+                {
+                    "type": "text",
+                    "text": prompt
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url
+                    }
+                }
+            ]
+            if self.speculator is not None:
+                self.speculator.start(screen, None if grid_on else elem_list, ui_doc, screenshot.image.shape[1],
+                                      screenshot.image.shape[0])
+            print_with_color("Thinking about what to do in the next step...", "yellow")
+            step_start = time.time()
+            rsp = ask_gpt4v(content, self.client)
+            latency["model"] += time.time() - step_start
+
+            if "error" not in rsp:
+                usage = ledger.record(round_count, "act", rsp, [(image_stats["width"], image_stats["height"])])
+                with open(log_path, "a") as logfile:
+                    log_item = {"step": round_count, "prompt": prompt, "image": f"{dir_name}_{round_count}_labeled.png",
+                                "image_payload": image_stats, "response": rsp, "usage": usage}
+                    logfile.write(json.dumps(log_item) + "\n")
+                if grid_on:
+                    res = parse_grid_rsp(rsp)
+                else:
+                    res = parse_explore_rsp(rsp)
+                act_name = res[0]
+                if act_name == "FINISH":
+                    task_complete = True
+                    with open(log_path, "a") as logfile:
+                        logfile.write(json.dumps({"step": round_count, "action": {"name": "FINISH"},
+                                                  "screen": screen}) + "\n")
+                    break
+                if act_name == "ERROR":
+                    break
+                last_act = res[-1]
+                res = res[:-1]
+                step_start = time.time()
+                if act_name == "tap":
+                    _, area = res
+                    x, y = elem_list.center(area - 1)
+                    ret = controller.tap(x, y)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: tap execution failed", "red")
+                        break
+                elif act_name == "text":
+                    _, input_str = res
+                    ret = controller.text(input_str)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: text execution failed", "red")
+                        break
+                elif act_name == "long_press":
+                    _, area = res
+                    x, y = elem_list.center(area - 1)
+                    ret = controller.long_press(x, y)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: long press execution failed", "red")
+                        break
+                elif act_name == "swipe":
+                    _, area, swipe_dir, dist = res
+                    x, y = elem_list.center(area - 1)
+                    ret = controller.swipe(x, y, swipe_dir, dist)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: swipe execution failed", "red")
+                        break
+                elif act_name == "grid":
+                    grid_on = True
+                elif act_name == "tap_grid" or act_name == "long_press_grid":
+                    _, area, subarea = res
+                    x, y = self.area_to_xy(area, subarea, grid)
+                    if act_name == "tap_grid":
+                        ret = controller.tap(x, y)
+                        if ret == "ERROR":
+                            print_with_color("ERROR: tap execution failed", "red")
+                            break
+                    else:
+                        ret = controller.long_press(x, y)
+                        if ret == "ERROR":
+                            print_with_color("ERROR: tap execution failed", "red")
+                            break
+                elif act_name == "swipe_grid":
+                    _, start_area, start_subarea, end_area, end_subarea = res
+                    start_x, start_y = self.area_to_xy(start_area, start_subarea, grid)
+                    end_x, end_y = self.area_to_xy(end_area, end_subarea, grid)
+                    ret = controller.swipe_precise((start_x, start_y), (end_x, end_y))
+                    if ret == "ERROR":
+                        print_with_color("ERROR: tap execution failed", "red")
+                        break
+                if act_name != "grid":
+                    grid_on = False
+                    # Actions are logged with the UID of their element and the screen they were taken on, so that
+                    # the task can be replayed by replay.py.
+                    if act_name in GRAPH_ACTIONS:
+                        action = {"name": act_name, "uid": elem_list.uid(area - 1),
+                                  "args": [swipe_dir, dist] if act_name == "swipe" else []}
+                    elif act_name == "text":
+                        action = {"name": "text", "args": [input_str]}
+                    elif act_name == "swipe_grid":
+                        action = {"name": "swipe_precise", "xy": [[start_x, start_y], [end_x, end_y]]}
+                    else:
+                        action = {"name": act_name[:-len("_grid")], "xy": [x, y]}
+                    with open(log_path, "a") as logfile:
+                        logfile.write(json.dumps({"step": round_count, "action": action, "screen": screen}) + "\n")
+                    if self.speculator is not None:
+                        self.speculator.record_action(action.get("uid"))
+                    if self.graph is not None:
+                        pending = (screen, action if "uid" in action else None, last_act)
+                controller.wait_until_settled()
+                latency["action"] += time.time() - step_start
+            else:
+                print_with_color(rsp["error"]["message"], "red")
+                break
+        for write in self.pending_writes:
+            write.result()
+        self.pending_writes = []
+        tracer.flush(log_path, round_count)
+
+        if task_complete:
+            status = "completed"
+            print_with_color("Task completed successfully", "yellow")
+        elif over_budget:
+            status = "budget"
+            print_with_color("Task aborted due to exceeding its budget", "red")
+        elif round_count == max_rounds:
+            status = "max_rounds"
+            print_with_color("Task finished due to reaching max rounds", "yellow")
+        else:
+            status = "error"
+            print_with_color("Task finished unexpectedly", "red")
+        if self.graph is not None:
+            if task_complete:
+                self.graph.add_route(task_desc, hops)
+            self.graph.save()
+        usage = ledger.finish(self.app_dir, {"task": task_desc, "task_dir": task_dir, "status": status})
+        report_usage(usage, self.app_dir)
+        speculation = None
+        if self.speculator is not None:
+            speculation = self.speculator.summary()
+            print_speculation_stats(speculation)
+        result = {"task": task_desc, "success": task_complete, "status": status, "rounds": round_count,
+                  "task_dir": task_dir, "elapsed": round(time.time() - start_time, 3),
+                  "latency": {stage: round(seconds, 3) for stage, seconds in latency.items()},
+                  "prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage["completion_tokens"],
+                  "image_tokens": usage["image_tokens"], "cost": round(usage["cost"], 4), "steps": ledger.steps(),
+                  "replayed": replayed, "speculation": speculation}
+        if perception_failed:
+            result["error"] = PERCEPTION_FAILED
+        return result
+
+
+class Explorer:
+    """The exploration-phase agent: explores an app on one device while trying to complete a task, and documents the UI
+    elements it interacts with in the app's auto_docs.
+
+    Like Agent, an Explorer can explore any number of tasks in a row and keeps its doc base, controller and model
+    client across them.
+    """
+
+    def __init__(self, app, controller, root_dir="./", client=None):
+        self.app = app
+        self.controller = controller
+        self.client = client or get_client()
+        self.app_dir = os.path.join(root_dir, "apps", app)
+        self.demo_dir = os.path.join(self.app_dir, "demos")
+        if not os.path.exists(self.demo_dir):
+            os.makedirs(self.demo_dir)
+        self.doc_store = DocStore(os.path.join(self.app_dir, "auto_docs"))
+        self.graph = get_screen_graph(self.app_dir)
+
+    def explore(self, task_desc, max_rounds=None):
+        """Explore the app for one task. Returns a summary with the outcome, the number of rounds, the docs generated,
+        the tokens and cost and the p50/p95 latency of every phase. Screenshots are downscaled further once the task
+        nears its budget, and the exploration is aborted when the budget is used up."""
+        tracer = Tracer(f"{self.app} exploration: {task_desc}")
+        with tracer.activate():
+            result = self._explore(task_desc, max_rounds or configs["MAX_ROUNDS"], tracer)
+        finish_trace(tracer, result)
+        return result
+
+    def _explore(self, task_desc, max_rounds, tracer):
+        controller = self.controller
+        doc_store = self.doc_store
+        doc_store.refresh()
+        start_time = time.time()
+        task_name = datetime.datetime.fromtimestamp(int(start_time)).strftime("self_explore_%Y-%m-%d_%H-%M-%S")
+        task_dir = make_run_dir(self.demo_dir, task_name)
+        task_name = os.path.basename(task_dir)
+        explore_log_path = os.path.join(task_dir, f"log_explore_{task_name}.txt")
+        reflect_log_path = os.path.join(task_dir, f"log_reflect_{task_name}.txt")
+
+        round_count = 0
+        doc_count = 0
+        useless_list = set()
+        last_act = "None"
+        task_complete = False
+        ledger = UsageLedger()
+        over_budget = False
+        hops = []
+        skipped_reflections = 0
+        while round_count < max_rounds:
+            tracer.flush(explore_log_path, round_count)
+            budget = ledger.check_budget()
+            if budget == BUDGET_EXCEEDED:
+                over_budget = True
+                break
+            max_edge = configs["BUDGET_IMAGE_MAX_EDGE"] if budget == BUDGET_DEGRADE else configs["IMAGE_MAX_EDGE"]
+            round_count += 1
+            print_with_color(f"Round {round_count}", "yellow")
+            screenshot_before, ui_tree = controller.perceive(f"{round_count}_before", task_dir)
+            if screenshot_before == "ERROR" or ui_tree == "ERROR":
+                break
+            if configs["LOG_UI_XML"]:
+                ui_tree.save()
+            if self.graph is not None:
+                with span("screen_signature"):
+                    screen = screen_signature(ui_tree)
+                self.graph.visit(screen)
+            with span("extract_elements"):
+                elem_list = extract_elements(ui_tree, useless_list)
+            with span("draw_bbox_multi"):
+                image, scale = fit_image(screenshot_before.image, max_edge)
+                labeled_before = draw_bbox_multi(image, os.path.join(task_dir, f"{round_count}_before_labeled.png"),
+                                                 elem_list, dark_mode=configs["DARK_MODE"], scale=scale)
+
+            prompt = re.sub(r"<task_description>", task_desc, prompts.self_explore_task_template)
+            prompt = re.sub(r"<last_act>", last_act, prompt)
+            with span("prepare_image"):
+                image_url_before, image_stats = prepare_image(labeled_before, configs["IMAGE_FORMAT"],
+                                                              configs["IMAGE_QUALITY"], configs["IMAGE_GRAYSCALE"])
+            content = [
+                {
+                    "type": "text",
+                    "text": prompt
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url_before
+                    }
+                }
+            ]
+            print_with_color("Thinking about what to do in the next step...", "yellow")
+            rsp = ask_gpt4v(content, self.client)
+
+            if "error" not in rsp:
+                usage = ledger.record(round_count, "act", rsp, [(image_stats["width"], image_stats["height"])])
+                with open(explore_log_path, "a") as logfile:
+                    log_item = {"step": round_count, "prompt": prompt, "image": f"{round_count}_before_labeled.png",
+                                "image_payload": image_stats, "response": rsp, "usage": usage}
+                    logfile.write(json.dumps(log_item) + "\n")
+                res = parse_explore_rsp(rsp)
+                act_name = res[0]
+                last_act = res[-1]
+                res = res[:-1]
+                if act_name == "FINISH":
+                    task_complete = True
+                    break
+                if act_name == "tap":
+                    _, area = res
+                    x, y = elem_list.center(area - 1)
+                    ret = controller.tap(x, y)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: tap execution failed", "red")
+                        break
+                elif act_name == "text":
+                    _, input_str = res
+                    ret = controller.text(input_str)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: text execution failed", "red")
+                        break
+                elif act_name == "long_press":
+                    _, area = res
+                    x, y = elem_list.center(area - 1)
+                    ret = controller.long_press(x, y)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: long press execution failed", "red")
+                        break
+                elif act_name == "swipe":
+                    _, area, swipe_dir, dist = res
+                    x, y = elem_list.center(area - 1)
+                    ret = controller.swipe(x, y, swipe_dir, dist)
+                    if ret == "ERROR":
+                        print_with_color("ERROR: swipe execution failed", "red")
+                        break
+                else:
+                    break
+                controller.wait_until_settled()
+                ui_tree_after = "ERROR"
+                if act_name in GRAPH_ACTIONS and (self.graph is not None or configs["SKIP_DEAD_ACTIONS"]):
+                    ui_tree_after = controller.dump_hierarchy(f"{round_count}_after", task_dir)
+                if self.graph is not None:
+                    hop = {"src": screen, "action": None, "dst": None, "summary": last_act}
+                    if ui_tree_after != "ERROR":
+                        hop["action"] = {"name": act_name, "uid": elem_list.uid(area - 1),
+                                         "args": [swipe_dir, dist] if act_name == "swipe" else []}
+                        hop["dst"] = screen_signature(ui_tree_after)
+                        self.graph.add_transition(screen, hop["action"], hop["dst"], last_act)
+                    hops.append(hop)
+            else:
+                print_with_color(rsp["error"]["message"], "red")
+                break
+
+            screenshot_after = None
+            if ui_tree_after != "ERROR" and configs["SKIP_DEAD_ACTIONS"]:
+                screenshot_after = controller.capture_screenshot(f"{round_count}_after", task_dir)
+                if screenshot_after == "ERROR":
+                    break
+                with span("classify_change"):
+                    change = classify_change(ui_tree, ui_tree_after, frame_fingerprint(screenshot_before.image),
+                                             frame_fingerprint(screenshot_after.image))
+                if change == CHANGE_NONE:
+                    resource_id = elem_list.uid(area - 1)
+                    print_with_color(f"Nothing changed on the screen. The element {resource_id} is marked as "
+                                     f"ineffective without reflection.", "yellow")
+                    useless_list.add(resource_id)
+                    last_act = "None"
+                    skipped_reflections += 1
+                    if self.graph is not None:
+                        hops.pop()
+                    with open(reflect_log_path, "a") as logfile:
+                        logfile.write(json.dumps({"step": round_count, "decision": "INEFFECTIVE",
+                                                  "change": change}) + "\n")
+                    continue
+            if screenshot_after is None:
+                screenshot_after = controller.capture_screenshot(f"{round_count}_after", task_dir)
+                if screenshot_after == "ERROR":
+                    break
+            screenshot_after.save()
+            with span("draw_bbox_multi"):
+                image, scale = fit_image(screenshot_after.image, max_edge)
+                labeled_after = draw_bbox_multi(image, os.path.join(task_dir, f"{round_count}_after_labeled.png"),
+                                                elem_list, dark_mode=configs["DARK_MODE"], scale=scale)
+            with span("prepare_image"):
+                image_url_after, image_stats_after = prepare_image(labeled_after, configs["IMAGE_FORMAT"],
+                                                                   configs["IMAGE_QUALITY"], configs["IMAGE_GRAYSCALE"])
+
+            if act_name == "tap":
+                prompt = re.sub(r"<action>", "tapping", prompts.self_explore_reflect_template)
+            elif act_name == "text":
+                continue
+            elif act_name == "long_press":
+                prompt = re.sub(r"<action>", "long pressing", prompts.self_explore_reflect_template)
+            elif act_name == "swipe":
+                swipe_dir = res[2]
+                if swipe_dir == "up" or swipe_dir == "down":
+                    act_name = "v_swipe"
+                elif swipe_dir == "left" or swipe_dir == "right":
+                    act_name = "h_swipe"
+                prompt = re.sub(r"<action>", "swiping", prompts.self_explore_reflect_template)
+            else:
+                print_with_color("ERROR: Undefined act!", "red")
+                break
+            prompt = re.sub(r"<ui_element>", str(area), prompt)
+            prompt = re.sub(r"<task_desc>", task_desc, prompt)
+            prompt = re.sub(r"<last_act>", last_act, prompt)
+
+            content = [
+                {
+                    "type": "text",
+                    "text": prompt
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url_before
+                    }
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url_after
+                    }
+                }
+            ]
+            print_with_color("Reflecting on my previous action...", "yellow")
+            rsp = ask_gpt4v(content, self.client)
+            if "error" not in rsp:
+                usage = ledger.record(round_count, "reflect", rsp, [(image_stats["width"], image_stats["height"]),
+                                                                    (image_stats_after["width"],
+                                                                     image_stats_after["height"])])
+                resource_id = elem_list.uid(int(area) - 1)
+                with open(reflect_log_path, "a") as logfile:
+                    log_item = {"step": round_count, "prompt": prompt,
+                                "image_before": f"{round_count}_before_labeled.png",
+                                "image_after": f"{round_count}_after.png", "response": rsp, "usage": usage}
+                    logfile.write(json.dumps(log_item) + "\n")
+                res = parse_reflect_rsp(rsp)
+                decision = res[0]
+                if decision == "ERROR":
+                    break
+                if (decision == "INEFFECTIVE" or decision == "BACK") and self.graph is not None:
+                    # The action did not move the task forward, so it is left out of the task's route.
+                    hops.pop()
+                if decision == "INEFFECTIVE":
+                    useless_list.add(resource_id)
+                    last_act = "None"
+                elif decision == "BACK" or decision == "CONTINUE" or decision == "SUCCESS":
+                    if decision == "BACK" or decision == "CONTINUE":
+                        useless_list.add(resource_id)
+                        last_act = "None"
+                        if decision == "BACK":
+                            ret = controller.back()
+                            if ret == "ERROR":
+                                print_with_color("ERROR: back execution failed", "red")
+                                break
+                            controller.wait_until_settled()
+                    doc = res[-1]
+                    doc_content = doc_store.get(resource_id)
+                    if doc_content and doc_content[act_name]:
+                        print_with_color(f"Documentation for the element {resource_id} already exists.", "yellow")
+                        continue
+                    doc_store.update(resource_id, act_name, doc)
+                    doc_count += 1
+                    print_with_color(f"Documentation generated and saved to {doc_store.path}", "yellow")
+                else:
+                    print_with_color(f"ERROR: Undefined decision! {decision}", "red")
+                    break
+            else:
+                print_with_color(rsp["error"]["message"], "red")
+                break
+        tracer.flush(explore_log_path, round_count)
+
+        if task_complete:
+            status = "completed"
+            print_with_color(f"Autonomous exploration completed successfully. {doc_count} docs generated.", "yellow")
+        elif over_budget:
+            status = "budget"
+            print_with_color(f"Autonomous exploration aborted due to exceeding its budget. {doc_count} docs generated.",
+                             "red")
+        elif round_count == max_rounds:
+            status = "max_rounds"
+            print_with_color(f"Autonomous exploration finished due to reaching max rounds. {doc_count} docs generated.",
+                             "yellow")
+        else:
+            status = "error"
+            print_with_color(f"Autonomous exploration finished unexpectedly. {doc_count} docs generated.", "red")
+        if self.graph is not None:
+            if task_complete:
+                self.graph.add_route(task_desc, hops)
+            self.graph.save()
+            print_with_color(f"The screen graph of {self.app} now has {len(self.graph)} screens", "yellow")
+        usage = ledger.finish(self.app_dir, {"task": task_desc, "task_dir": task_dir, "status": status})
+        report_usage(usage, self.app_dir)
+        return {"task": task_desc, "success": task_complete, "status": status, "rounds": round_count,
+                "docs": doc_count, "skipped_reflections": skipped_reflections, "task_dir": task_dir,
+                "elapsed": round(time.time() - start_time, 3),
+                "prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage["completion_tokens"],
+                "image_tokens": usage["image_tokens"], "cost": round(usage["cost"], 4), "steps": ledger.steps()}
+
+
+class DocGenerator:
+    """Generates the demo_docs of an app from recorded human demonstrations. No device is needed."""
+
+    def __init__(self, app, root_dir="./", client=None):
+        self.app = app
+        self.client = client or get_client()
+        self.app_dir = os.path.join(root_dir, "apps", app)
+        self.demo_dir = os.path.join(self.app_dir, "demos")
+        self.doc_store = DocStore(os.path.join(self.app_dir, "demo_docs"))
+        self.last_usage = None
+        self.last_errors = 0
+
+    @staticmethod
+    def encode_labeled_image(task_dir, name):
+        """Encode the labeled screenshot of a demo step for upload. A screenshot larger than IMAGE_MAX_EDGE is labeled
+        again after its raw screenshot is downscaled, so that the tags keep their full size. Demos without the raw
+        screenshot and hierarchy of the step send the labeled screenshot at its full resolution."""
+        image = load_image(os.path.join(task_dir, "labeled_screenshots", f"{name}.png"))
+        raw_path = os.path.join(task_dir, "raw_screenshots", f"{name}.png")
+        xml_path = os.path.join(task_dir, "xml", f"{name}.xml")
+        max_edge = configs["IMAGE_MAX_EDGE"]
+        if max_edge and max(image.shape[:2]) > max_edge and os.path.exists(raw_path) and os.path.exists(xml_path):
+            image, scale = fit_image(load_image(raw_path), max_edge)
+            image = draw_bbox_multi(image, None, extract_elements(xml_path), record_mode=True, scale=scale)
+        image_url, image_stats = prepare_image(image, configs["IMAGE_FORMAT"], configs["IMAGE_QUALITY"],
+                                               configs["IMAGE_GRAYSCALE"])
+        return image_url, (image_stats["width"], image_stats["height"])
+
+    def parse_record(self, rec, task_desc):
+        """Turn a line of record.txt into (action_type, resource_id, prompt), or None for an unknown action."""
+        action, resource_id = rec.split(":::")
+        action_type = action.split("(")[0]
+        action_param = re.findall(r"\((.*?)\)", action)[0]
+        if action_type == "tap":
+            prompt_template = prompts.tap_doc_template
+            prompt = re.sub(r"<ui_element>", action_param, prompt_template)
+        elif action_type == "text":
+            input_area, input_text = action_param.split(":sep:")
+            prompt_template = prompts.text_doc_template
+            prompt = re.sub(r"<ui_element>", input_area, prompt_template)
+        elif action_type == "long_press":
+            prompt_template = prompts.long_press_doc_template
+            prompt = re.sub(r"<ui_element>", action_param, prompt_template)
+        elif action_type == "swipe":
+            swipe_area, swipe_dir = action_param.split(":sep:")
+            if swipe_dir == "up" or swipe_dir == "down":
+                action_type = "v_swipe"
+            elif swipe_dir == "left" or swipe_dir == "right":
+                action_type = "h_swipe"
+            prompt_template = prompts.swipe_doc_template
+            prompt = re.sub(r"<swipe_dir>", swipe_dir, prompt_template)
+            prompt = re.sub(r"<ui_element>", swipe_area, prompt)
+        else:
+            return None
+        prompt = re.sub(r"<task_desc>", task_desc, prompt)
+        return action_type, resource_id, prompt
+
+    def generate(self, demo_name, workers=None, pool=None):
+        """Document the elements touched in one demo. Returns the number of docs generated, or None when the demo is
+        missing or incomplete. The usage of the run and the number of steps that failed or were skipped once the budget
+        was used up are kept in `last_usage` and `last_errors`; `last_usage` is None when the demo could not be read.
+
+        Steps are documented concurrently by up to `workers` threads (DOC_WORKERS by default), or on the given thread
+        pool so that several demos can share one. Only steps on the same element and action depend on each other,
+        through the existing doc and the DOC_REFINE chain, so each such chain runs in order on one thread. Outcomes are
+        committed to the log and the doc base in step order, so the result is the same as documenting the steps one by
+        one.
+        """
+        self.last_usage = None
+        self.last_errors = 0
+        task_dir = os.path.join(self.demo_dir, demo_name)
+        xml_dir = os.path.join(task_dir, "xml")
+        labeled_ss_dir = os.path.join(task_dir, "labeled_screenshots")
+        record_path = os.path.join(task_dir, "record.txt")
+        task_desc_path = os.path.join(task_dir, "task_desc.txt")
+        if not os.path.exists(task_dir) or not os.path.exists(xml_dir) or not os.path.exists(labeled_ss_dir) \
+                or not os.path.exists(record_path) or not os.path.exists(task_desc_path):
+            print_with_color(f"ERROR: The demo {demo_name} of the app {self.app} is missing or incomplete", "red")
+            return None
+        log_path = os.path.join(task_dir, f"log_{self.app}_{demo_name}.txt")
+        doc_store = self.doc_store
+        doc_store.refresh()
+        with open(task_desc_path, "r") as f:
+            task_desc = f.read()
+        with open(record_path, "r") as f:
+            records = f.readlines()
+
+        print_with_color(f"Starting to generate documentations for the app {self.app} based on the demo {demo_name}",
+                         "yellow")
+        steps = []
+        chains = {}
+        for i, rec in enumerate(records[:-1], 1):
+            parsed = self.parse_record(rec.strip(), task_desc)
+            if parsed is None:
+                break
+            steps.append(i)
+            chains.setdefault(parsed[:2], []).append((i,) + parsed)
+
+        ledger = UsageLedger()
+        lock = threading.Lock()
+        outcomes = {}
+        committed = [0, 0, 0]
+        workers = workers or configs["DOC_WORKERS"]
+        encode_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="doc-encode")
+        images = {}
+
+        def image(index):
+            with lock:
+                if index not in images:
+                    images[index] = encode_pool.submit(self.encode_labeled_image, task_dir, f"{demo_name}_{index}")
+                return images[index]
+
+        def commit(i, outcome):
+            """Store the outcome of step i and apply every outcome whose preceding steps are all applied."""
+            with lock:
+                outcomes[i] = outcome
+                while committed[0] < len(steps) and steps[committed[0]] in outcomes:
+                    ready = outcomes.pop(steps[committed[0]])
+                    for message, color in ready["messages"]:
+                        print_with_color(message, color)
+                    committed[2] += int(ready.get("failed", False))
+                    if ready.get("doc"):
+                        with open(log_path, "a") as logfile:
+                            logfile.write(json.dumps(ready["log_item"]) + "\n")
+                        doc_store.update(*ready["doc"])
+                        committed[1] += 1
+                        print_with_color(f"Documentation generated and saved to {doc_store.path}", "yellow")
+                    committed[0] += 1
+
+        def document_chain(chain):
+            _, action_type, resource_id, _ = chain[0]
+            doc_content = doc_store.get(resource_id)
+            doc = doc_content[action_type] if doc_content else ""
+            for i, _, _, prompt in chain:
+                messages = []
+                try:
+                    if doc:
+                        if not configs["DOC_REFINE"]:
+                            commit(i, {"messages": [(f"Documentation for the element {resource_id} already exists. "
+                                                     f"Turn on DOC_REFINE in the config file if needed.", "yellow")]})
+                            continue
+                        prompt += re.sub(r"<old_doc>", doc, prompts.refine_doc_suffix)
+                        messages.append((f"Documentation for the element {resource_id} already exists. The doc will "
+                                         f"be refined based on the latest demo.", "yellow"))
+                    if ledger.check_budget() == BUDGET_EXCEEDED:
+                        # Counted as failed so that the demo is not recorded as up to date and the step is
+                        # documented on a later run.
+                        commit(i, {"messages": messages + [(f"Step {i} is not documented since the budget is used "
+                                                            f"up", "red")], "failed": True})
+                        continue
+                    img_before, size_before = image(i).result()
+                    img_after, size_after = image(i + 1).result()
+                    print_with_color(f"Waiting for GPT-4V to generate documentation for the element {resource_id}",
+                                     "yellow")
+                    content = [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": img_before
+                            }
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": img_after
+                            }
+                        }
+                    ]
+                    rsp = ask_gpt4v(content, self.client)
+                    if "error" not in rsp:
+                        doc = rsp["choices"][0]["message"]["content"]
+                        usage = ledger.record(i, "doc", rsp, [size_before, size_after])
+                        log_item = {"step": i, "prompt": prompt, "image_before": f"{demo_name}_{i}.png",
+                                    "image_after": f"{demo_name}_{i + 1}.png", "response": rsp, "usage": usage}
+                        commit(i, {"messages": messages, "doc": (resource_id, action_type, doc), "log_item": log_item})
+                    else:
+                        commit(i, {"messages": messages + [(rsp["error"]["message"], "red")], "failed": True})
+                except Exception as e:
+                    commit(i, {"messages": messages + [(f"ERROR: failed to document step {i}: {e}", "red")],
+                               "failed": True})
+
+        # Prefetch the screenshots of the steps that are sure to be sent to the model.
+        for chain in chains.values():
+            doc_content = doc_store.get(chain[0][2])
+            if configs["DOC_REFINE"] or not (doc_content and doc_content[chain[0][1]]):
+                image(chain[0][0])
+                image(chain[0][0] + 1)
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="doc-chain") as own_pool:
+                list(own_pool.map(document_chain, chains.values()))
+        else:
+            list(pool.map(document_chain, chains.values()))
+        encode_pool.shutdown()
+
+        doc_count = committed[1]
+        print_with_color(f"Documentation generation phase completed. {doc_count} docs generated.", "yellow")
+        self.last_errors = committed[2]
+        self.last_usage = ledger.finish(self.app_dir, {"task": f"docs of {demo_name}", "task_dir": task_dir,
+                                                       "status": "completed"})
+        report_usage(self.last_usage, self.app_dir)
+        return doc_count
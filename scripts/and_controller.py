@@ -1,8 +1,20 @@
+import math
 import os
+import queue
+import shlex
+import struct
 import subprocess
+import threading
+import time
+import uuid
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
 
 from config import load_config
+from tracing import bind, traced
 from utils import print_with_color
 
 
@@ -10,6 +22,8 @@ configs = load_config()
 
 
 class AndroidElement:
+    __slots__ = ("uid", "bbox", "attrib")
+
     def __init__(self, uid, bbox, attrib):
         self.uid = uid
         self.bbox = bbox
@@ -26,8 +40,303 @@ def execute_adb(adb_command):
     return "ERROR"
 
 
+CLICKABLE, FOCUSABLE, LONG_CLICKABLE, SCROLLABLE = 1, 2, 4, 8
+ELEMENT_FLAGS = ((CLICKABLE, "clickable"), (FOCUSABLE, "focusable"), (LONG_CLICKABLE, "long-clickable"),
+                 (SCROLLABLE, "scrollable"))
+ELEMENT_DTYPE = np.dtype([("x1", np.int32), ("y1", np.int32), ("x2", np.int32), ("y2", np.int32),
+                          ("cx", np.int32), ("cy", np.int32), ("flags", np.uint8), ("kind", np.uint8),
+                          ("uid", np.int32)])
+ELEMENT_KINDS = ("clickable", "focusable")
+
+
+class ElementTable:
+    """The interactive elements of one screen as a NumPy structured array of ELEMENT_DTYPE rows.
+
+    Row i is the element labeled with the numeric tag i + 1. `kind` tells whether the element was collected as a
+    clickable or a focusable one, `flags` is a bitmask of its CLICKABLE/FOCUSABLE/LONG_CLICKABLE/SCROLLABLE
+    attributes and `uid` indexes `uid_pool`, the UIDs of the screen, which is freed along with the table. Indexing or
+    iterating the table yields AndroidElement views.
+    """
+
+    def __init__(self, rows=(), uid_pool=()):
+        self.rows = np.array(rows, dtype=ELEMENT_DTYPE)
+        self.uid_pool = list(uid_pool)
+        self.uid_ids = {uid: uid_id for uid_id, uid in enumerate(self.uid_pool)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        row = self.rows[i]
+        return AndroidElement(self.uid_pool[row["uid"]],
+                              ((int(row["x1"]), int(row["y1"])), (int(row["x2"]), int(row["y2"]))),
+                              ELEMENT_KINDS[row["kind"]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def uid(self, i):
+        return self.uid_pool[self.rows["uid"][i]]
+
+    def uids(self):
+        return [self.uid_pool[uid] for uid in self.rows["uid"].tolist()]
+
+    def attribs(self):
+        return [ELEMENT_KINDS[kind] for kind in self.rows["kind"].tolist()]
+
+    def center(self, i):
+        return int(self.rows["cx"][i]), int(self.rows["cy"][i])
+
+    def centers(self):
+        return np.stack((self.rows["cx"], self.rows["cy"]), axis=-1)
+
+    def areas(self):
+        return (self.rows["x2"] - self.rows["x1"]).astype(np.int64) * (self.rows["y2"] - self.rows["y1"])
+
+    def has_flag(self, flag):
+        return (self.rows["flags"] & flag) != 0
+
+    def contains(self, x, y):
+        """Return a mask of the elements whose bounding box contains the point (x, y)."""
+        return (self.rows["x1"] <= x) & (x <= self.rows["x2"]) & (self.rows["y1"] <= y) & (y <= self.rows["y2"])
+
+    def nearest(self, x, y):
+        """Return the index of the element whose center is closest to the point (x, y), or -1 for an empty table."""
+        if not len(self):
+            return -1
+        dx = self.rows["cx"].astype(np.int64) - x
+        dy = self.rows["cy"].astype(np.int64) - y
+        return int(np.argmin(dx * dx + dy * dy))
+
+    def index(self, uid):
+        """Return the index of the first element with the given UID, or -1 if it is not on the screen."""
+        uid_id = self.uid_ids.get(uid)
+        if uid_id is None:
+            return -1
+        matches = np.flatnonzero(self.rows["uid"] == uid_id)
+        return int(matches[0]) if len(matches) else -1
+
+
+class Screenshot:
+    """A screen capture held in memory as a BGR array. The image file is only written when `save` is called."""
+
+    def __init__(self, image, path, encoded=None):
+        self.image = image
+        self.path = path
+        self.encoded = encoded
+        self.saved = False
+
+    def save(self):
+        if not self.saved:
+            if self.encoded is not None:
+                with open(self.path, "wb") as f:
+                    f.write(self.encoded)
+            else:
+                cv2.imwrite(self.path, self.image)
+            self.saved = True
+        return self.path
+
+
+class UIHierarchy:
+    """A UI hierarchy dump parsed straight from the bytes streamed off the device. The XML file is only written when
+    `save` is called."""
+
+    def __init__(self, raw, path):
+        self.raw = raw
+        self.path = path
+        self.root = ET.fromstring(raw)
+        self.saved = False
+
+    def save(self):
+        if not self.saved:
+            with open(self.path, "wb") as f:
+                f.write(self.raw)
+            self.saved = True
+        return self.path
+
+
+def extract_xml(output):
+    start = output.find("<?xml")
+    if start < 0:
+        start = output.find("<hierarchy")
+    end = output.rfind("</hierarchy>")
+    if start < 0 or end < 0:
+        return None
+    return output[start:end + len("</hierarchy>")]
+
+
+def execute_adb_shell(device, command):
+    """Run a shell command on the device through a one-off adb process, returning its output like `execute_adb`.
+
+    The command is handed to adb as a single argument without going through a host shell, so that pipes,
+    redirections and `&&` in it are run by the shell on the device, as they are in the persistent session.
+    """
+    adb_command = shlex.split(configs["ADB_PATH"]) + ["-s", device, "shell", command]
+    result = subprocess.run(adb_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode == 0:
+        return result.stdout.strip()
+    print_with_color(f"Command execution failed: {configs['ADB_PATH']} -s {device} shell {command}", "red")
+    print_with_color(result.stderr, "red")
+    return "ERROR"
+
+
+def execute_adb_binary(adb_args):
+    result = subprocess.run(shlex.split(configs["ADB_PATH"]) + adb_args, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    if result.returncode == 0:
+        return result.stdout
+    print_with_color(f"Command execution failed: adb {' '.join(adb_args)}", "red")
+    print_with_color(result.stderr.decode(errors="replace"), "red")
+    return "ERROR"
+
+
+def decode_screencap(data, raw=False):
+    if not raw:
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    # The raw framebuffer is a little-endian header (width, height, format and, since Android 9, color space)
+    # followed by width * height RGBA pixels.
+    width, height, _ = struct.unpack_from("<3I", data)
+    offset = len(data) - width * height * 4
+    if offset not in (12, 16):
+        return None
+    rgba = np.frombuffer(data, np.uint8, offset=offset).reshape(height, width, 4)
+    return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+
+
+def frame_fingerprint(image):
+    """A downscaled grayscale thumbnail of a frame, cheap to compare and blind to sub-pixel noise."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (36, 80), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def fingerprints_match(fp_a, fp_b, change_tolerance, cell_tolerance=8):
+    """Whether at most the `change_tolerance` fraction of the cells of two frame fingerprints differ by more than
+    `cell_tolerance` gray levels."""
+    if fp_a is None or fp_b is None or fp_a.shape != fp_b.shape:
+        return False
+    return np.count_nonzero(np.abs(fp_a - fp_b) > cell_tolerance) <= change_tolerance * fp_a.size
+
+
+# Commands that act on the device, and may have done so when their session died before reporting back.
+UNREPEATABLE_COMMANDS = ("input ", "monkey ", "am start")
+
+
+class AdbShell:
+    """A long-lived `adb -s <serial> shell` process that commands are written to one at a time.
+
+    The output of each command is framed by a unique sentinel line carrying its exit code, so a single adb client and
+    connection are reused for the whole run. Whenever the session dies or a command times out, a command that only
+    reads the device is executed once more through `execute_adb_shell`, while one that acts on it fails, since it may
+    have been executed already. The session is restarted lazily on the next call. After `max_failures` failures in a
+    row, commands go through `execute_adb_shell` for ADB_SHELL_COOLDOWN seconds before the session is tried again.
+    """
+
+    max_failures = 3
+
+    def __init__(self, device):
+        self.device = device
+        self.timeout = configs["ADB_SHELL_TIMEOUT"]
+        self.proc = None
+        self.lines = None
+        self.failures = 0
+        self.disabled_at = None
+        self.lock = threading.Lock()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        adb_command = shlex.split(configs["ADB_PATH"]) + ["-s", self.device, "shell"]
+        try:
+            self.proc = subprocess.Popen(adb_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print_with_color(f"Failed to start the adb shell session on {self.device}: {e}", "red")
+            self.proc = None
+            return False
+        self.lines = queue.Queue()
+        threading.Thread(target=self._pump, args=(self.proc, self.lines), daemon=True).start()
+        return True
+
+    @staticmethod
+    def _pump(proc, lines):
+        for line in iter(proc.stdout.readline, b""):
+            lines.put(line)
+        lines.put(None)
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def run(self, command):
+        """Run a shell command on the device and return its output like `execute_adb`, i.e. "ERROR" on failure."""
+        with self.lock:
+            if self.disabled_at is not None and time.monotonic() - self.disabled_at >= configs["ADB_SHELL_COOLDOWN"]:
+                self.disabled_at = None
+                self.failures = 0
+            if self.failures < self.max_failures:
+                if not self.alive() and not self.start():
+                    self.failures += 1
+                else:
+                    ret = self._run(command)
+                    if ret is not None:
+                        return ret
+                    self.failures += 1
+                    self.close()
+                    if command.startswith(UNREPEATABLE_COMMANDS):
+                        print_with_color(f"ERROR: the adb shell session on {self.device} failed during {command}, "
+                                         f"which is not run again since it may have been executed", "red")
+                        self.disable_if_failing()
+                        return "ERROR"
+                self.disable_if_failing()
+        return execute_adb_shell(self.device, command)
+
+    def disable_if_failing(self):
+        if self.failures >= self.max_failures and self.disabled_at is None:
+            self.disabled_at = time.monotonic()
+            print_with_color(f"The adb shell session on {self.device} keeps dying, falling back to one adb process "
+                             f"per command for {configs['ADB_SHELL_COOLDOWN']}s", "red")
+
+    def _run(self, command):
+        sentinel = f"__APPAGENT_{uuid.uuid4().hex}__"
+        # The extra echo guarantees the sentinel starts on its own line even if the output has no trailing newline.
+        framed = f"{command} 2>&1; __rc=$?; echo; echo {sentinel} $__rc\n"
+        try:
+            self.proc.stdin.write(framed.encode())
+            self.proc.stdin.flush()
+        except OSError:
+            return None
+        output = []
+        while True:
+            try:
+                line = self.lines.get(timeout=self.timeout)
+            except queue.Empty:
+                print_with_color(f"Command timed out in the adb shell session: {command}", "red")
+                return None
+            if line is None:
+                return None
+            line = line.decode(errors="replace").rstrip("\r\n")
+            if line.startswith(sentinel):
+                break
+            output.append(line)
+        self.failures = 0
+        result = "\n".join(output).strip()
+        if line.split()[-1] == "0":
+            return result
+        print_with_color(f"Command execution failed: {command}", "red")
+        print_with_color(result, "red")
+        return "ERROR"
+
+
 def list_all_devices():
-    adb_command = "adb devices"
+    adb_command = f"{configs['ADB_PATH']} devices"
     device_list = []
     result = execute_adb(adb_command)
     if result != "ERROR":
@@ -53,9 +362,22 @@ def get_id_from_element(elem):
     return elem_id
 
 
+def iter_tree(xml):
+    """Yield ('start', elem) and ('end', elem) events like ET.iterparse, from either a file path or a parsed tree."""
+    if isinstance(xml, str):
+        yield from ET.iterparse(xml, ['start', 'end'])
+        return
+    if isinstance(xml, UIHierarchy):
+        xml = xml.root
+    yield 'start', xml
+    for child in xml:
+        yield from iter_tree(child)
+    yield 'end', xml
+
+
 def traverse_tree(xml_path, elem_list, attrib, add_index=False):
     path = []
-    for event, elem in ET.iterparse(xml_path, ['start', 'end']):
+    for event, elem in iter_tree(xml_path):
         if event == 'start':
             path.append(elem)
             if attrib in elem.attrib and elem.attrib[attrib] == "true":
@@ -86,28 +408,122 @@ def traverse_tree(xml_path, elem_list, attrib, add_index=False):
             path.pop()
 
 
+class CenterIndex:
+    """A spatial hash of element centers answering "is any center within MIN_DIST of this one" in constant time."""
+
+    def __init__(self, min_dist):
+        self.min_dist = min_dist
+        self.cell = max(math.ceil(min_dist), 1)
+        self.cells = {}
+
+    def add(self, center):
+        self.cells.setdefault((center[0] // self.cell, center[1] // self.cell), []).append(center)
+
+    def has_close(self, center):
+        col, row = center[0] // self.cell, center[1] // self.cell
+        for i in (col - 1, col, col + 1):
+            for j in (row - 1, row, row + 1):
+                for center_ in self.cells.get((i, j), ()):
+                    dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
+                    if dist <= self.min_dist:
+                        return True
+        return False
+
+
+def extract_elements(xml, useless_list=(), add_index=True):
+    """Collect the interactive elements of a UI hierarchy in a single pass.
+
+    This yields the same elements, in the same order and with the same UIDs, as running traverse_tree for "clickable"
+    and then "focusable" and appending the focusable elements that are not within MIN_DIST of a clickable one.
+    Elements whose UID is in `useless_list` are left out but still shadow nearby focusable elements.
+    """
+    min_dist = configs["MIN_DIST"]
+    clickable_rows, focusable_rows = [], []
+    clickable_index, focusable_index = CenterIndex(min_dist), CenterIndex(min_dist)
+    uid_pool, uid_ids = [], {}
+    path = []
+    for event, elem in iter_tree(xml):
+        if event == 'end':
+            path.pop()
+            continue
+        path.append(elem)
+        is_clickable = elem.attrib.get("clickable") == "true"
+        is_focusable = elem.attrib.get("focusable") == "true"
+        if not is_clickable and not is_focusable:
+            continue
+        bounds = elem.attrib["bounds"][1:-1].split("][")
+        x1, y1 = map(int, bounds[0].split(","))
+        x2, y2 = map(int, bounds[1].split(","))
+        center = (x1 + x2) // 2, (y1 + y2) // 2
+        elem_id = None
+        for kind, is_attrib, rows, index in ((0, is_clickable, clickable_rows, clickable_index),
+                                             (1, is_focusable, focusable_rows, focusable_index)):
+            if not is_attrib or index.has_close(center):
+                continue
+            if elem_id is None:
+                elem_id = get_id_from_element(elem)
+                if len(path) > 1:
+                    elem_id = get_id_from_element(path[-2]) + "_" + elem_id
+                if add_index:
+                    elem_id += f"_{elem.attrib['index']}"
+                flags = 0
+                for flag, name in ELEMENT_FLAGS:
+                    if elem.attrib.get(name) == "true":
+                        flags |= flag
+                uid = uid_ids.get(elem_id)
+                if uid is None:
+                    uid = uid_ids[elem_id] = len(uid_pool)
+                    uid_pool.append(elem_id)
+            index.add(center)
+            rows.append((x1, y1, x2, y2, center[0], center[1], flags, kind, uid))
+    useless = {uid_ids[uid] for uid in useless_list if uid in uid_ids}
+    rows = [row for row in clickable_rows if row[-1] not in useless]
+    for row in focusable_rows:
+        if row[-1] not in useless and not clickable_index.has_close((row[4], row[5])):
+            rows.append(row)
+    return ElementTable(rows, uid_pool)
+
+
 class AndroidController:
     def __init__(self, device):
         self.device = device
+        self.adb = f"{configs['ADB_PATH']} -s {device}"
         self.screenshot_dir = configs["ANDROID_SCREENSHOT_DIR"]
         self.xml_dir = configs["ANDROID_XML_DIR"]
+        self.shell_session = AdbShell(device) if configs["ADB_PERSISTENT_SHELL"] else None
         self.width, self.height = self.get_device_size()
         self.backslash = "\\"
+        self.tty_dump = True
+        self.screen_fingerprints = True
+        self.capture_pool = None
+
+    def shell(self, command):
+        if self.shell_session is not None:
+            return self.shell_session.run(command)
+        return execute_adb_shell(self.device, command)
 
+    def close(self):
+        if self.shell_session is not None:
+            self.shell_session.close()
+        if self.capture_pool is not None:
+            self.capture_pool.shutdown()
+            self.capture_pool = None
+
+    @traced("adb.get_device_size")
     def get_device_size(self):
-        adb_command = f"adb -s {self.device} shell wm size"
-        result = execute_adb(adb_command)
+        result = self.shell("wm size")
         if result != "ERROR":
             return map(int, result.split(": ")[1].split("x"))
         return 0, 0
 
+    @traced("adb.get_screenshot")
     def get_screenshot(self, prefix, save_dir):
-        cap_command = f"adb -s {self.device} shell screencap -p " \
+        cap_command = f"screencap -p " \
                       f"{os.path.join(self.screenshot_dir, prefix + '.png').replace(self.backslash, '/')}"
-        pull_command = f"adb -s {self.device} pull " \
+        pull_command = f"{self.adb} pull " \
                        f"{os.path.join(self.screenshot_dir, prefix + '.png').replace(self.backslash, '/')} " \
                        f"{os.path.join(save_dir, prefix + '.png')}"
-        result = execute_adb(cap_command)
+        result = self.shell(cap_command)
         if result != "ERROR":
             result = execute_adb(pull_command)
             if result != "ERROR":
@@ -115,13 +531,125 @@ class AndroidController:
             return result
         return result
 
+    @traced("adb.screen_fingerprint")
+    def screen_fingerprint(self):
+        """Stream a frame over `adb exec-out` in SCREENSHOT_FORMAT and return its fingerprint, or None when the screen
+        cannot be read."""
+        raw = configs["SCREENSHOT_FORMAT"] == "raw"
+        data = execute_adb_binary(["-s", self.device, "exec-out", "screencap"] + ([] if raw else ["-p"]))
+        if data == "ERROR":
+            return None
+        image = decode_screencap(data, raw)
+        return None if image is None else frame_fingerprint(image)
+
+    @traced("adb.wait_until_settled")
+    def wait_until_settled(self, timeout=None):
+        """Poll fingerprints of the screen until SETTLE_FRAMES consecutive ones match or `timeout` seconds pass.
+
+        Fingerprints match when at most the SETTLE_TOLERANCE fraction of them changed, so that a blinking cursor or a
+        spinner does not keep the screen from settling. Returns True if the screen settled. On a device whose screen
+        cannot be read, which is remembered after the first failure, this degrades into a blind sleep of SETTLE_FRAMES
+        polling intervals.
+        """
+        if not self.screen_fingerprints:
+            time.sleep(configs["SETTLE_INTERVAL"] * configs["SETTLE_FRAMES"])
+            return False
+        timeout = configs["SETTLE_TIMEOUT"] if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        last_fp = None
+        matches = 0
+        while True:
+            time.sleep(configs["SETTLE_INTERVAL"])
+            fp = self.screen_fingerprint()
+            if fp is None:
+                print_with_color(f"The screen of {self.device} cannot be read, waiting a fixed time for it to settle "
+                                 f"from now on", "yellow")
+                self.screen_fingerprints = False
+                time.sleep(configs["SETTLE_INTERVAL"] * (configs["SETTLE_FRAMES"] - 1))
+                return False
+            if fingerprints_match(fp, last_fp, configs["SETTLE_TOLERANCE"]):
+                matches += 1
+                if matches >= configs["SETTLE_FRAMES"] - 1:
+                    return True
+            else:
+                matches = 0
+            last_fp = fp
+            if time.monotonic() >= deadline:
+                print_with_color(f"The screen did not settle within {timeout}s", "yellow")
+                return False
+
+    @traced("adb.capture_screenshot")
+    def capture_screenshot(self, prefix, save_dir):
+        """Stream the screen over `adb exec-out` straight into memory instead of a file on the device plus a pull."""
+        path = os.path.join(save_dir, prefix + ".png")
+        if configs["SCREENSHOT_EXEC_OUT"]:
+            raw = configs["SCREENSHOT_FORMAT"] == "raw"
+            data = execute_adb_binary(["-s", self.device, "exec-out", "screencap"] + ([] if raw else ["-p"]))
+            if data != "ERROR":
+                image = decode_screencap(data, raw)
+                if image is not None:
+                    return Screenshot(image, path, None if raw else data)
+            print_with_color("Failed to stream the screenshot, falling back to screencap and pull", "red")
+        result = self.get_screenshot(prefix, save_dir)
+        if result == "ERROR":
+            return result
+        screenshot = Screenshot(cv2.imread(result), result)
+        screenshot.saved = True
+        return screenshot
+
+    @traced("adb.dump_hierarchy")
+    def dump_hierarchy(self, prefix, save_dir):
+        """Stream the UI hierarchy back over stdout and parse it in memory instead of a file on the device plus a
+        pull. Devices that cannot dump to /dev/tty dump to ANDROID_XML_DIR and print the file in the same command."""
+        path = os.path.join(save_dir, prefix + ".xml")
+        if configs["UI_DUMP_STDOUT"]:
+            xml = None
+            if self.tty_dump:
+                xml = extract_xml(self.shell("uiautomator dump /dev/tty"))
+                if xml is None:
+                    print_with_color("uiautomator cannot dump to /dev/tty on this device, dumping to "
+                                     f"{self.xml_dir} instead", "yellow")
+                    self.tty_dump = False
+            if xml is None:
+                device_path = os.path.join(self.xml_dir, "window_dump.xml").replace(self.backslash, '/')
+                xml = extract_xml(self.shell(f"uiautomator dump {device_path} && cat {device_path}"))
+            if xml is not None:
+                try:
+                    return UIHierarchy(xml.encode(), path)
+                except ET.ParseError as e:
+                    print_with_color(f"Failed to parse the UI hierarchy streamed from the device: {e}", "red")
+        result = self.get_xml(prefix, save_dir)
+        if result == "ERROR":
+            return result
+        with open(result, "rb") as f:
+            ui = UIHierarchy(f.read(), result)
+        ui.saved = True
+        return ui
+
+    @traced("adb.perceive")
+    def perceive(self, prefix, save_dir):
+        """Capture the screen and dump the UI hierarchy. Returns (screenshot, ui_tree), either of which may be "ERROR".
+
+        With PIPELINED_PERCEPTION the screencap, which streams over its own `adb exec-out`, runs on a worker thread
+        while the hierarchy is dumped through the shell session, so a round waits for the slower of the two instead of
+        both.
+        """
+        if not configs["PIPELINED_PERCEPTION"]:
+            return self.capture_screenshot(prefix, save_dir), self.dump_hierarchy(prefix, save_dir)
+        if self.capture_pool is None:
+            self.capture_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"capture-{self.device}")
+        screenshot = self.capture_pool.submit(bind(self.capture_screenshot), prefix, save_dir)
+        ui_tree = self.dump_hierarchy(prefix, save_dir)
+        return screenshot.result(), ui_tree
+
+    @traced("adb.get_xml")
     def get_xml(self, prefix, save_dir):
-        dump_command = f"adb -s {self.device} shell uiautomator dump " \
+        dump_command = f"uiautomator dump " \
                        f"{os.path.join(self.xml_dir, prefix + '.xml').replace(self.backslash, '/')}"
-        pull_command = f"adb -s {self.device} pull " \
+        pull_command = f"{self.adb} pull " \
                        f"{os.path.join(self.xml_dir, prefix + '.xml').replace(self.backslash, '/')} " \
                        f"{os.path.join(save_dir, prefix + '.xml')}"
-        result = execute_adb(dump_command)
+        result = self.shell(dump_command)
         if result != "ERROR":
             result = execute_adb(pull_command)
             if result != "ERROR":
@@ -129,28 +657,42 @@ class AndroidController:
             return result
         return result
 
+    @traced("adb.back")
     def back(self):
-        adb_command = f"adb -s {self.device} shell input keyevent KEYCODE_BACK"
-        ret = execute_adb(adb_command)
+        ret = self.shell("input keyevent KEYCODE_BACK")
+        return ret
+
+    @traced("adb.reset_app")
+    def reset_app(self, package):
+        """Force-stop the app and launch it again from its launcher activity, so the next task starts from the main
+        interface."""
+        ret = self.shell(f"am force-stop {package}")
+        if ret == "ERROR":
+            return ret
+        ret = self.shell(f"monkey -p {package} -c android.intent.category.LAUNCHER 1")
+        if ret == "ERROR":
+            return ret
+        self.wait_until_settled()
         return ret
 
+    @traced("adb.tap")
     def tap(self, x, y):
-        adb_command = f"adb -s {self.device} shell input tap {x} {y}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(f"input tap {x} {y}")
         return ret
 
+    @traced("adb.text")
     def text(self, input_str):
         input_str = input_str.replace(" ", "%s")
         input_str = input_str.replace("'", "")
-        adb_command = f"adb -s {self.device} shell input text {input_str}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(f"input text {input_str}")
         return ret
 
+    @traced("adb.long_press")
     def long_press(self, x, y, duration=1000):
-        adb_command = f"adb -s {self.device} shell input swipe {x} {y} {x} {y} {duration}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(f"input swipe {x} {y} {x} {y} {duration}")
         return ret
 
+    @traced("adb.swipe")
     def swipe(self, x, y, direction, dist="medium", quick=False):
         unit_dist = int(self.width / 10)
         if dist == "long":
@@ -168,13 +710,36 @@ class AndroidController:
         else:
             return "ERROR"
         duration = 100 if quick else 400
-        adb_command = f"adb -s {self.device} shell input swipe {x} {y} {x+offset[0]} {y+offset[1]} {duration}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(f"input swipe {x} {y} {x+offset[0]} {y+offset[1]} {duration}")
         return ret
 
+    @traced("adb.swipe_precise")
     def swipe_precise(self, start, end, duration=400):
         start_x, start_y = start
         end_x, end_y = end
-        adb_command = f"adb -s {self.device} shell input swipe {start_x} {start_x} {end_x} {end_y} {duration}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(f"input swipe {start_x} {start_x} {end_x} {end_y} {duration}")
         return ret
+
+
+def connect_device(device=None):
+    """Connect to the given device, or to the only attached one, asking the user to choose when there are several.
+    Returns None when no usable device is found."""
+    if not device:
+        device_list = list_all_devices()
+        if not device_list:
+            print_with_color("ERROR: No device found!", "red")
+            return None
+        print_with_color(f"List of devices attached:\n{str(device_list)}", "yellow")
+        if len(device_list) == 1:
+            device = device_list[0]
+            print_with_color(f"Device selected: {device}", "yellow")
+        else:
+            print_with_color("Please choose the Android device to start demo by entering its ID:", "blue")
+            device = input()
+    controller = AndroidController(device)
+    if not controller.width and not controller.height:
+        print_with_color("ERROR: Invalid device size!", "red")
+        controller.close()
+        return None
+    print_with_color(f"Screen resolution of {device}: {controller.width}x{controller.height}", "yellow")
+    return controller
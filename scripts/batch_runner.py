@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import sys
+
+from and_controller import list_all_devices
+from multi_device import MultiDeviceRunner, print_summary
+from utils import print_with_color
+
+
+def load_tasks(tasks_path):
+    """Read the task records of a JSONL file. A record without an "id" gets its line number, which is how finished
+    records are recognized when the batch is resumed."""
+    tasks = []
+    with open(tasks_path, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            task = json.loads(line)
+            task.setdefault("id", line_no)
+            tasks.append(task)
+    return tasks
+
+
+# The statuses of tasks that ran to an end. Tasks that ended with an error are run again when the batch is resumed.
+FINISHED_STATUSES = ("completed", "max_rounds", "budget")
+
+
+def load_finished(results_path):
+    """The ids of the tasks with a result that ran to an end."""
+    finished = set()
+    if not os.path.exists(results_path):
+        return finished
+    with open(results_path, "r") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                if result["status"] in FINISHED_STATUSES:
+                    finished.add(result["id"])
+            except (ValueError, KeyError):
+                # A line cut short by a crash while it was being appended.
+                continue
+    return finished
+
+
+def run_batch(tasks_path, results_path=None, devices=None, root_dir="./"):
+    """Run every unfinished record of the tasks file and append a result per task to the results file, which
+    defaults to `<tasks>_results.jsonl`. Tasks whose last run ended with an error are run again. Returns the run
+    statistics, or None when no device is found."""
+    results_path = results_path or os.path.splitext(tasks_path)[0] + "_results.jsonl"
+    tasks = load_tasks(tasks_path)
+    finished = load_finished(results_path)
+    pending = [task for task in tasks if task["id"] not in finished]
+    if os.path.exists(results_path):
+        print_with_color(f"Resuming the batch: {len(tasks) - len(pending)} of {len(tasks)} tasks already finished",
+                         "yellow")
+    devices = devices or list_all_devices()
+    if not devices:
+        print_with_color("ERROR: No device found!", "red")
+        return None
+    print_with_color(f"Running {len(pending)} tasks on {len(devices)} devices: {devices}", "yellow")
+    runner = MultiDeviceRunner(devices, root_dir, results_path=results_path)
+    _, stats = runner.run(pending)
+    print_summary(stats)
+    print_with_color(f"Results saved to {results_path}", "yellow")
+    return stats
+
+
+if __name__ == "__main__":
+    arg_desc = "AppAgent - Batch Executor"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc,
+                                     epilog="Each line of the tasks file is a JSON record such as\n"
+                                            '{"app": "x", "task": "...", "docs": "auto", "max_rounds": 10, '
+                                            '"package": "com.x.android"}\nwhere only app and task are required.')
+    parser.add_argument("--tasks", required=True, help="a JSONL file with one task record per line")
+    parser.add_argument("--results", help="the JSONL file results are appended to, <tasks>_results.jsonl by default")
+    parser.add_argument("--devices", help="comma-separated device IDs, all attached devices by default")
+    parser.add_argument("--root_dir", default="./")
+    args = vars(parser.parse_args())
+    if run_batch(args["tasks"], args["results"], args["devices"].split(",") if args["devices"] else None,
+                 args["root_dir"]) is None:
+        sys.exit(1)
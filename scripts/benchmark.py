@@ -0,0 +1,276 @@
+import argparse
+import functools
+import random
+import statistics
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import xml.etree.ElementTree as ET
+
+import agent
+import and_controller
+from and_controller import AndroidController, AndroidElement, extract_elements, list_all_devices, traverse_tree
+from screen_graph import screen_signature
+from utils import GridLayout, draw_bbox_multi, element_labels, get_grid_layout, print_with_color
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print_with_color(f"{name:<40} median {statistics.median(timings) * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms",
+                     "yellow")
+
+
+def bench_capture(args):
+    device = args["device"] or list_all_devices()[0]
+    controller = AndroidController(device)
+    configs = and_controller.configs
+    save_dir = tempfile.mkdtemp()
+
+    def pull_and_read(i):
+        return cv2.imread(controller.get_screenshot(f"bench_{i}", save_dir))
+
+    def exec_out(fmt):
+        def capture(i):
+            configs["SCREENSHOT_FORMAT"] = fmt
+            return controller.capture_screenshot(f"bench_{i}", save_dir).image
+        return capture
+
+    cases = [("screencap + pull + imread", pull_and_read), ("exec-out screencap -p", exec_out("png")),
+             ("exec-out screencap (raw)", exec_out("raw"))]
+    exec_out_enabled = configs["SCREENSHOT_EXEC_OUT"]
+    configs["SCREENSHOT_EXEC_OUT"] = True
+    for name, capture in cases:
+        timings = []
+        for i in range(args["rounds"]):
+            start = time.perf_counter()
+            capture(i)
+            timings.append(time.perf_counter() - start)
+        report(name, timings)
+    configs["SCREENSHOT_EXEC_OUT"] = exec_out_enabled
+    controller.close()
+
+
+def synthetic_hierarchy(n, width=1440, height=3200, seed=0):
+    """Build a UI hierarchy with n nodes nested in rows of cells, like a feed or a keyboard."""
+    rng = random.Random(seed)
+    root = ET.Element("hierarchy", rotation="0")
+    parent = ET.SubElement(root, "node", {"index": "0", "class": "android.widget.FrameLayout", "resource-id": "",
+                                          "content-desc": "", "clickable": "false", "focusable": "false",
+                                          "bounds": f"[0,0][{width},{height}]"})
+    count = 1
+    row = 0
+    while count < n:
+        cells = rng.randint(1, 12)
+        top = rng.randrange(0, height - 60)
+        container = ET.SubElement(parent, "node", {"index": str(row), "class": "android.widget.LinearLayout",
+                                                   "resource-id": f"app:id/row{row % 7}", "content-desc": "",
+                                                   "clickable": "false", "focusable": "false",
+                                                   "bounds": f"[0,{top}][{width},{top + 60}]"})
+        count += 1
+        for i in range(min(cells, n - count)):
+            left = rng.randrange(0, width - 40)
+            w, h = rng.randint(20, 200), rng.randint(20, 60)
+            ET.SubElement(container, "node", {"index": str(i), "class": "android.widget.Button",
+                                              "resource-id": rng.choice(["", f"app:id/key{i}"]),
+                                              "content-desc": rng.choice(["", f"Key {i}"]),
+                                              "clickable": rng.choice(["true", "false"]),
+                                              "focusable": rng.choice(["true", "false"]),
+                                              "bounds": f"[{left},{top}][{min(left + w, width)},{top + h}]"})
+            count += 1
+        row += 1
+    return root
+
+
+def double_traverse(xml):
+    clickable_list = []
+    focusable_list = []
+    traverse_tree(xml, clickable_list, "clickable", True)
+    traverse_tree(xml, focusable_list, "focusable", True)
+    elem_list = clickable_list.copy()
+    for elem in focusable_list:
+        bbox = elem.bbox
+        center = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
+        close = False
+        for e in clickable_list:
+            bbox = e.bbox
+            center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
+            dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
+            if dist <= and_controller.configs["MIN_DIST"]:
+                close = True
+                break
+        if not close:
+            elem_list.append(elem)
+    return elem_list
+
+
+def bench_elements(args):
+    save_dir = tempfile.mkdtemp()
+    for n in (100, 1000, 5000):
+        xml_path = f"{save_dir}/synthetic_{n}.xml"
+        ET.ElementTree(synthetic_hierarchy(n)).write(xml_path)
+        expected = [(e.uid, e.bbox, e.attrib) for e in double_traverse(xml_path)]
+        actual = [(e.uid, e.bbox, e.attrib) for e in extract_elements(xml_path)]
+        if expected != actual:
+            print_with_color(f"extract_elements differs from traverse_tree on {n} nodes", "red")
+        for name, extract in (("traverse_tree x2 + merge", double_traverse), ("extract_elements", extract_elements)):
+            timings = []
+            for _ in range(args["rounds"]):
+                start = time.perf_counter()
+                extract(xml_path)
+                timings.append(time.perf_counter() - start)
+            report(f"{name} ({n} nodes)", timings)
+
+
+def put_b_text(img, text, x, y, background_rgb, text_rgb, alpha=0.5, space=10):
+    """pyshine.putBText, which draw_bbox_multi used to call for every tag."""
+    (text_width, text_height) = cv2.getTextSize(text, cv2.FONT_HERSHEY_DUPLEX, fontScale=1, thickness=2)[0]
+    crop = img[y - space:y + text_height + space, x - space:x + text_width + space]
+    white_rect = np.ones(crop.shape, dtype=np.uint8)
+    b, g, r = cv2.split(white_rect)
+    rect_changed = cv2.merge((background_rgb[2] * b, background_rgb[1] * g, background_rgb[0] * r))
+    img[y - space:y + text_height + space, x - space:x + text_width + space] = \
+        cv2.addWeighted(crop, alpha, rect_changed, 1 - alpha, 0)
+    cv2.putText(img, text, (x, y + text_height), cv2.FONT_HERSHEY_DUPLEX, fontScale=1,
+                color=(text_rgb[2], text_rgb[1], text_rgb[0]), thickness=2)
+    return img
+
+
+def put_b_text_labels(img, elem_list):
+    img = img.copy()
+    for count, ((center_x, center_y), _) in enumerate(element_labels(elem_list), 1):
+        img = put_b_text(img, str(count), center_x + 10, center_y + 10, (10, 10, 10), (255, 250, 250))
+    return img
+
+
+def bench_labels(args):
+    rng = np.random.default_rng(0)
+    width, height = 1440, 3200
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    for n in (10, 50, 100, 500):
+        elem_list = []
+        for i in range(n):
+            left, top = int(rng.integers(0, width - 200)), int(rng.integers(0, height - 100))
+            elem_list.append(AndroidElement(f"elem_{i}", ((left, top), (left + 200, top + 100)), "clickable"))
+        # Where two strokes of a glyph overlap, putText rounds twice and a sprite once, so pixels may be off by one.
+        diff = cv2.absdiff(put_b_text_labels(image, elem_list), draw_bbox_multi(image, None, elem_list))
+        if diff.max() > 1:
+            print_with_color(f"draw_bbox_multi differs from putBText with {n} elements", "red")
+        for name, label in (("putBText per element", put_b_text_labels),
+                            ("cached label sprites", lambda img, elems: draw_bbox_multi(img, None, elems))):
+            timings = []
+            for _ in range(args["rounds"]):
+                start = time.perf_counter()
+                label(image, elem_list)
+                timings.append(time.perf_counter() - start)
+            report(f"{name} ({n} elements)", timings)
+
+
+def draw_grid_cells(image):
+    """The grid as draw_grid used to draw it on every screenshot: a rectangle and two labels per cell."""
+    def get_unit_len(n):
+        for i in range(1, n + 1):
+            if n % i == 0 and 120 <= i <= 180:
+                return i
+        return -1
+
+    image = image.copy()
+    height, width, _ = image.shape
+    color = (255, 116, 113)
+    unit_height = get_unit_len(height)
+    if unit_height < 0:
+        unit_height = 120
+    unit_width = get_unit_len(width)
+    if unit_width < 0:
+        unit_width = 120
+    thick = int(unit_width // 50)
+    rows = height // unit_height
+    cols = width // unit_width
+    for i in range(rows):
+        for j in range(cols):
+            label = i * cols + j + 1
+            left = int(j * unit_width)
+            top = int(i * unit_height)
+            right = int((j + 1) * unit_width)
+            bottom = int((i + 1) * unit_height)
+            cv2.rectangle(image, (left, top), (right, bottom), color, thick // 2)
+            cv2.putText(image, str(label), (left + int(unit_width * 0.05) + 3, top + int(unit_height * 0.3) + 3), 0,
+                        int(0.01 * unit_width), (0, 0, 0), thick)
+            cv2.putText(image, str(label), (left + int(unit_width * 0.05), top + int(unit_height * 0.3)), 0,
+                        int(0.01 * unit_width), color, thick)
+    return image
+
+
+def bench_grid(args):
+    rng = np.random.default_rng(0)
+    for width, height in ((720, 1600), (1080, 2400), (1440, 3200)):
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        start = time.perf_counter()
+        grid = GridLayout(width, height)
+        print_with_color(f"GridLayout {width}x{height}: {grid.rows}x{grid.cols} cells, built in "
+                         f"{(time.perf_counter() - start) * 1000:.1f} ms", "yellow")
+        # The overlay does not antialias the labels, so only pixels far from the drawn grid count as differences.
+        diff = cv2.absdiff(draw_grid_cells(image), get_grid_layout(width, height).draw(image)).max(axis=2)
+        print_with_color(f"{np.count_nonzero(diff > 128) / diff.size:.3%} of the pixels differ from the drawn grid",
+                         "yellow")
+        for name, draw in (("rectangle + putText per cell", draw_grid_cells),
+                           ("cached GridLayout overlay", lambda img: get_grid_layout(width, height).draw(img))):
+            timings = []
+            for _ in range(args["rounds"]):
+                start = time.perf_counter()
+                draw(image)
+                timings.append(time.perf_counter() - start)
+            report(f"{name} ({width}x{height})", timings)
+
+
+def bench_perception(args):
+    """Time the perception stage of an agent round, from the capture to the encoded payload, with the captures and the
+    labeling run one after the other and with PIPELINED_PERCEPTION."""
+    device = args["device"] or list_all_devices()[0]
+    controller = AndroidController(device)
+    save_dir = tempfile.mkdtemp()
+    pipelined = and_controller.configs["PIPELINED_PERCEPTION"]
+    for name, enabled in (("serial perception round", False), ("pipelined perception round", True)):
+        and_controller.configs["PIPELINED_PERCEPTION"] = agent.configs["PIPELINED_PERCEPTION"] = enabled
+        runner = agent.Agent("benchmark", controller, root_dir=save_dir, client=object())
+        timings = []
+        for i in range(args["rounds"]):
+            start = time.perf_counter()
+            screenshot, ui_tree = controller.perceive(f"bench_{i}", save_dir)
+            elem_list = extract_elements(ui_tree)
+            render = functools.partial(runner.render_screenshot, screenshot.image, agent.configs["IMAGE_MAX_EDGE"],
+                                       f"{save_dir}/bench_{i}_labeled.png", elem_list=elem_list)
+            rendered = runner.pipeline.submit(render) if runner.pipeline is not None else None
+            screen_signature(ui_tree)
+            rendered.result() if rendered is not None else render()
+            timings.append(time.perf_counter() - start)
+            # The labeled image is written while the model thinks, which the benchmark does not wait for.
+            for write in runner.pending_writes:
+                write.result()
+            runner.pending_writes = []
+        report(name, timings)
+    and_controller.configs["PIPELINED_PERCEPTION"] = agent.configs["PIPELINED_PERCEPTION"] = pipelined
+    controller.close()
+
+
+if __name__ == "__main__":
+    arg_desc = "AppAgent - Benchmarks. Point ADB_PATH at scripts/fake_adb.py and FAKE_ADB_SCREEN at a recorded " \
+               "screenshot to benchmark against a fixture instead of a phone."
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("bench", choices=["capture", "elements", "labels", "grid", "perception"])
+    parser.add_argument("--device")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = vars(parser.parse_args())
+    if args["bench"] == "capture":
+        bench_capture(args)
+    elif args["bench"] == "elements":
+        bench_elements(args)
+    elif args["bench"] == "labels":
+        bench_labels(args)
+    elif args["bench"] == "grid":
+        bench_grid(args)
+    elif args["bench"] == "perception":
+        bench_perception(args)
@@ -0,0 +1,106 @@
+import ast
+import json
+import os
+import threading
+
+from utils import print_with_color
+
+DOC_ACTIONS = ("tap", "text", "v_swipe", "h_swipe", "long_press")
+DOC_FILE = "docs.jsonl"
+
+
+def empty_doc():
+    return {action: "" for action in DOC_ACTIONS}
+
+
+class DocStore:
+    """The documentation base of an app (its auto_docs or demo_docs directory), loaded into memory once.
+
+    Docs live in a single append-only docs.jsonl file with one {"uid", "action", "doc"} record per line, the last
+    record winning, so saving a doc appends one line instead of rewriting a file. Docs in the legacy format, one
+    `<uid>.txt` file holding a str(dict) per element, are read as well and overridden by docs.jsonl. `refresh`
+    reloads the base when another process has changed it since it was loaded.
+    """
+
+    def __init__(self, docs_dir):
+        self.docs_dir = docs_dir
+        self.path = os.path.join(docs_dir, DOC_FILE)
+        self.docs = {}
+        self.records = 0
+        self.stamp = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def _stamp(self):
+        if not os.path.exists(self.docs_dir):
+            return None
+        dir_mtime = os.stat(self.docs_dir).st_mtime_ns
+        if not os.path.exists(self.path):
+            return dir_mtime, None, None
+        stat = os.stat(self.path)
+        return dir_mtime, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        with self.lock:
+            docs = {}
+            records = 0
+            if os.path.exists(self.docs_dir):
+                for name in os.listdir(self.docs_dir):
+                    if not name.endswith(".txt"):
+                        continue
+                    try:
+                        with open(os.path.join(self.docs_dir, name), "r") as f:
+                            docs[name[:-4]] = ast.literal_eval(f.read())
+                    except (OSError, ValueError, SyntaxError) as e:
+                        print_with_color(f"ERROR: failed to read the documentation {name}: {e}", "red")
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # A line cut short by a crash while it was being appended.
+                            continue
+                        docs.setdefault(record["uid"], empty_doc())[record["action"]] = record["doc"]
+                        records += 1
+            self.docs = docs
+            self.records = records
+            self.stamp = self._stamp()
+
+    def refresh(self):
+        if self._stamp() != self.stamp:
+            self.load()
+
+    def __contains__(self, uid):
+        return uid in self.docs
+
+    def __len__(self):
+        return len(self.docs)
+
+    def get(self, uid):
+        return self.docs.get(uid)
+
+    def update(self, uid, action, doc):
+        with self.lock:
+            self.docs.setdefault(uid, empty_doc())[action] = doc
+            if not os.path.exists(self.docs_dir):
+                os.makedirs(self.docs_dir)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"uid": uid, "action": action, "doc": doc}) + "\n")
+            self.records += 1
+            self.stamp = self._stamp()
+
+    def compact(self):
+        """Rewrite docs.jsonl with exactly one record per non-empty doc, folding in the legacy files."""
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            records = 0
+            with open(tmp_path, "w") as f:
+                for uid, doc_content in self.docs.items():
+                    for action in DOC_ACTIONS:
+                        if doc_content.get(action):
+                            f.write(json.dumps({"uid": uid, "action": action, "doc": doc_content[action]}) + "\n")
+                            records += 1
+            os.replace(tmp_path, self.path)
+            self.records = records
+            self.stamp = self._stamp()
@@ -1,141 +1,163 @@
 import argparse
-import ast
+import hashlib
 import json
 import os
-import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import prompts
+from agent import DocGenerator
 from config import load_config
-from model import ask_gpt4v
-from utils import print_with_color, encode_image
-
-arg_desc = "AppAgent - Human Demonstration"
-parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
-parser.add_argument("--app", required=True)
-parser.add_argument("--demo", required=True)
-parser.add_argument("--root_dir", default="./")
-args = vars(parser.parse_args())
+from utils import print_with_color
 
 configs = load_config()
 
-root_dir = args["root_dir"]
-work_dir = os.path.join(root_dir, "apps")
-if not os.path.exists(work_dir):
-    os.mkdir(work_dir)
-app = args["app"]
-work_dir = os.path.join(work_dir, app)
-demo_dir = os.path.join(work_dir, "demos")
-demo_name = args["demo"]
-task_dir = os.path.join(demo_dir, demo_name)
-xml_dir = os.path.join(task_dir, "xml")
-labeled_ss_dir = os.path.join(task_dir, "labeled_screenshots")
-record_path = os.path.join(task_dir, "record.txt")
-task_desc_path = os.path.join(task_dir, "task_desc.txt")
-if not os.path.exists(task_dir) or not os.path.exists(xml_dir) or not os.path.exists(labeled_ss_dir) \
-        or not os.path.exists(record_path) or not os.path.exists(task_desc_path):
-    sys.exit()
-log_path = os.path.join(task_dir, f"log_{app}_{demo_name}.txt")
-
-docs_dir = os.path.join(work_dir, "demo_docs")
-if not os.path.exists(docs_dir):
-    os.mkdir(docs_dir)
-
-print_with_color(f"Starting to generate documentations for the app {app} based on the demo {demo_name}", "yellow")
-doc_count = 0
-with open(record_path, "r") as infile:
-    step = len(infile.readlines()) - 1
-    infile.seek(0)
-    for i in range(1, step + 1):
-        img_before = encode_image(os.path.join(labeled_ss_dir, f"{demo_name}_{i}.png"))
-        img_after = encode_image(os.path.join(labeled_ss_dir, f"{demo_name}_{i + 1}.png"))
-        rec = infile.readline().strip()
-        action, resource_id = rec.split(":::")
-        action_type = action.split("(")[0]
-        action_param = re.findall(r"\((.*?)\)", action)[0]
-        if action_type == "tap":
-            prompt_template = prompts.tap_doc_template
-            prompt = re.sub(r"<ui_element>", action_param, prompt_template)
-        elif action_type == "text":
-            input_area, input_text = action_param.split(":sep:")
-            prompt_template = prompts.text_doc_template
-            prompt = re.sub(r"<ui_element>", input_area, prompt_template)
-        elif action_type == "long_press":
-            prompt_template = prompts.long_press_doc_template
-            prompt = re.sub(r"<ui_element>", action_param, prompt_template)
-        elif action_type == "swipe":
-            swipe_area, swipe_dir = action_param.split(":sep:")
-            if swipe_dir == "up" or swipe_dir == "down":
-                action_type = "v_swipe"
-            elif swipe_dir == "left" or swipe_dir == "right":
-                action_type = "h_swipe"
-            prompt_template = prompts.swipe_doc_template
-            prompt = re.sub(r"<swipe_dir>", swipe_dir, prompt_template)
-            prompt = re.sub(r"<ui_element>", swipe_area, prompt)
-        else:
-            break
-        task_desc = open(task_desc_path, "r").read()
-        prompt = re.sub(r"<task_desc>", task_desc, prompt)
-
-        doc_name = resource_id + ".txt"
-        doc_path = os.path.join(docs_dir, doc_name)
-
-        if os.path.exists(doc_path):
-            doc_content = ast.literal_eval(open(doc_path).read())
-            if doc_content[action_type]:
-                if configs["DOC_REFINE"]:
-                    suffix = re.sub(r"<old_doc>", doc_content[action_type], prompts.refine_doc_suffix)
-                    prompt += suffix
-                    print_with_color(f"Documentation for the element {resource_id} already exists. The doc will be "
-                                     f"refined based on the latest demo.", "yellow")
-                else:
-                    print_with_color(f"Documentation for the element {resource_id} already exists. Turn on DOC_REFINE "
-                                     f"in the config file if needed.", "yellow")
-                    continue
-        else:
-            doc_content = {
-                "tap": "",
-                "text": "",
-                "v_swipe": "",
-                "h_swipe": "",
-                "long_press": ""
-            }
-
-        print_with_color(f"Waiting for GPT-4V to generate documentation for the element {resource_id}", "yellow")
-        content = [
-            {
-                "type": "text",
-                "text": prompt
-            },
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{img_before}"
-                }
-            },
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{img_after}"
-                }
-            }
-        ]
-
-        rsp = ask_gpt4v(content)
-        if "error" not in rsp:
-            msg = rsp["choices"][0]["message"]["content"]
-            doc_content[action_type] = msg
-            with open(log_path, "a") as logfile:
-                log_item = {"step": i, "prompt": prompt, "image_before": f"{demo_name}_{i}.png",
-                            "image_after": f"{demo_name}_{i + 1}.png", "response": rsp}
-                logfile.write(json.dumps(log_item) + "\n")
-            with open(doc_path, "w") as outfile:
-                outfile.write(str(doc_content))
-            doc_count += 1
-            print_with_color(f"Documentation generated and saved to {doc_path}", "yellow")
-        else:
-            print_with_color(rsp["error"]["message"], "red")
-        time.sleep(configs["REQUEST_INTERVAL"])
-
-print_with_color(f"Documentation generation phase completed. {doc_count} docs generated.", "yellow")
+DOC_MANIFEST = "manifest.json"
+
+
+def prompt_version():
+    """A hash of everything besides the demo itself that shapes the generated docs: the doc prompts, the model and
+    the doc and image settings."""
+    parts = [prompts.tap_doc_template, prompts.text_doc_template, prompts.long_press_doc_template,
+             prompts.swipe_doc_template, prompts.refine_doc_suffix, configs["OPENAI_API_MODEL"], configs["DOC_REFINE"],
+             configs["IMAGE_MAX_EDGE"], configs["IMAGE_FORMAT"], configs["IMAGE_QUALITY"], configs["IMAGE_GRAYSCALE"]]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def demo_hash(task_dir, version):
+    """The content hash of a demo: its record, task description and labeled screenshots, plus the prompt version."""
+    digest = hashlib.sha256(version.encode())
+    for name in ("record.txt", "task_desc.txt"):
+        with open(os.path.join(task_dir, name), "rb") as f:
+            digest.update(f.read())
+    labeled_ss_dir = os.path.join(task_dir, "labeled_screenshots")
+    for name in sorted(os.listdir(labeled_ss_dir)):
+        digest.update(name.encode())
+        with open(os.path.join(labeled_ss_dir, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def generate_all(root_dir="./", apps=None, force=False, workers=None):
+    """Generate the demo_docs of every demo under apps/*/demos/*, or of the given apps only.
+
+    A demo is skipped when its content hash matches the one recorded in `demo_docs/manifest.json` after its docs were
+    last generated, so an interrupted run resumes with the demos it had not finished. Apps are processed in parallel
+    while the demos of one app run in order, since they build on each other's docs. All demos share one pool of
+    `workers` threads for their model calls. Returns the report, which is also saved to apps/docs_report.json.
+    """
+    workers = workers or configs["DOC_WORKERS"]
+    apps_dir = os.path.join(root_dir, "apps")
+    if apps is None:
+        apps = sorted(name for name in os.listdir(apps_dir) if os.path.isdir(os.path.join(apps_dir, name, "demos")))
+    jobs = {}
+    for app in apps:
+        demo_dir = os.path.join(apps_dir, app, "demos")
+        if os.path.isdir(demo_dir):
+            jobs[app] = sorted(name for name in os.listdir(demo_dir)
+                               if os.path.exists(os.path.join(demo_dir, name, "record.txt")))
+    total = sum(len(demos) for demos in jobs.values())
+    version = prompt_version()
+    start_time = time.time()
+    lock = threading.Lock()
+    report = {"demos": total, "generated": 0, "skipped": 0, "failed": 0, "docs": 0, "cost": 0.0, "details": []}
+    print_with_color(f"Found {total} demos of {len(jobs)} apps", "yellow")
+
+    def progress(app, demo_name, status, docs=0, cost=0.0):
+        with lock:
+            report[status] += 1
+            report["docs"] += docs
+            report["cost"] += cost
+            report["details"].append({"app": app, "demo": demo_name, "status": status, "docs": docs,
+                                      "cost": round(cost, 4)})
+            done = report["generated"] + report["skipped"] + report["failed"]
+            elapsed = time.time() - start_time
+            print_with_color(f"[{done}/{total}] {app}/{demo_name}: {status}, {docs} docs, {elapsed:.0f}s elapsed",
+                             "yellow" if status != "failed" else "red")
+
+    def generate_app(app, pool):
+        generator = DocGenerator(app, root_dir)
+        manifest_path = os.path.join(generator.doc_store.docs_dir, DOC_MANIFEST)
+        manifest = load_manifest(manifest_path)
+        for demo_name in jobs[app]:
+            try:
+                content_hash = demo_hash(os.path.join(generator.demo_dir, demo_name), version)
+            except OSError as e:
+                print_with_color(f"ERROR: failed to read the demo {app}/{demo_name}: {e}", "red")
+                progress(app, demo_name, "failed")
+                continue
+            if not force and manifest.get(demo_name, {}).get("hash") == content_hash:
+                progress(app, demo_name, "skipped")
+                continue
+            try:
+                doc_count = generator.generate(demo_name, pool=pool)
+            except Exception as e:
+                print_with_color(f"ERROR: an exception occurs while documenting {app}/{demo_name}: {e}", "red")
+                doc_count = None
+            # The model calls of a demo that failed part way are paid for as well.
+            cost = generator.last_usage["cost"] if generator.last_usage else 0
+            if doc_count is None or generator.last_errors:
+                # Failed steps and steps skipped for the budget are retried on the next run, since the demo is not
+                # recorded as up to date.
+                progress(app, demo_name, "failed", doc_count or 0, cost)
+                continue
+            manifest[demo_name] = {"hash": content_hash, "docs": doc_count, "generated_at": time.time()}
+            if not os.path.exists(generator.doc_store.docs_dir):
+                os.makedirs(generator.doc_store.docs_dir)
+            save_manifest(manifest_path, manifest)
+            progress(app, demo_name, "generated", doc_count, cost)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="doc-chain") as pool:
+        with ThreadPoolExecutor(max_workers=min(workers, len(jobs)) or 1, thread_name_prefix="doc-app") as app_pool:
+            list(app_pool.map(lambda app: generate_app(app, pool), jobs))
+
+    report["cost"] = round(report["cost"], 4)
+    report["elapsed"] = round(time.time() - start_time, 3)
+    with open(os.path.join(apps_dir, "docs_report.json"), "w") as f:
+        json.dump(report, f, indent=1)
+    print_with_color(f"Bulk documentation completed in {report['elapsed']:.0f}s: {report['generated']} demos "
+                     f"documented, {report['skipped']} up to date, {report['failed']} failed, {report['docs']} docs "
+                     f"generated, ${report['cost']:.2f} spent", "yellow")
+    return report
+
+
+def main(app, demo, root_dir="./"):
+    return DocGenerator(app, root_dir).generate(demo)
+
+
+if __name__ == "__main__":
+    arg_desc = "AppAgent - Human Demonstration"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("--app", help="the app to document. With --all and no --app, every app is documented")
+    parser.add_argument("--demo", help="the demo to document. Required unless --all is given")
+    parser.add_argument("--all", action="store_true", help="document every demo that is not up to date")
+    parser.add_argument("--force", action="store_true", help="with --all, document up-to-date demos as well")
+    parser.add_argument("--workers", type=int, help="the number of concurrent model calls, DOC_WORKERS by default")
+    parser.add_argument("--root_dir", default="./")
+    args = vars(parser.parse_args())
+    if args["all"]:
+        generate_all(args["root_dir"], [args["app"]] if args["app"] else None, args["force"], args["workers"])
+    elif args["app"] and args["demo"]:
+        main(args["app"], args["demo"], args["root_dir"])
+    else:
+        parser.print_usage()
+        sys.exit(1)
@@ -0,0 +1,166 @@
+"""A stand-in for the adb executable that emulates a phone on the host, so the agent can run without a device.
+
+Set ADB_PATH to "python scripts/fake_adb.py" in config.yaml to use it. Device shell commands are run by a local `sh`
+in which `wm`, `input`, `am`, `monkey`, `screencap` and `uiautomator` are replaced by fakes: inputs and app launches
+are appended to the log file and captures are served from fixture files. The fake is configured through the following
+environment variables:
+
+FAKE_ADB_DEVICES: comma-separated serials reported by `adb devices` (default "emulator-5554")
+FAKE_ADB_SIZE: screen resolution reported by `wm size` (default "1080x2400")
+FAKE_ADB_SCREEN: PNG file returned by `screencap` (default: a blank screen generated on first use). Its raw RGBA
+    framebuffer for `screencap` without -p is derived from it and cached under the root directory
+FAKE_ADB_XML: UI hierarchy returned by `uiautomator dump` (default: a small generated hierarchy)
+FAKE_ADB_ROOT: host directory that mirrors the device file system (default: <tmp>/fake_adb)
+FAKE_ADB_LOG: file that every input command is appended to (default: <root>/input.log)
+"""
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+
+ROOT = os.environ.get("FAKE_ADB_ROOT", os.path.join(tempfile.gettempdir(), "fake_adb"))
+SIZE = os.environ.get("FAKE_ADB_SIZE", "1080x2400")
+DEVICES = os.environ.get("FAKE_ADB_DEVICES", "emulator-5554").split(",")
+LOG = os.environ.get("FAKE_ADB_LOG", os.path.join(ROOT, "input.log"))
+
+PRELUDE = r"""
+cat() {
+    for f; do
+        case "$f" in /sdcard*|/data/local/tmp*) command cat "$FAKE_ADB_ROOT$f" ;; *) command cat "$f" ;; esac
+    done
+}
+wm() { echo "Physical size: $FAKE_ADB_SIZE"; }
+input() { echo "$FAKE_ADB_SERIAL input $*" >> "$FAKE_ADB_LOG"; }
+am() { echo "$FAKE_ADB_SERIAL am $*" >> "$FAKE_ADB_LOG"; }
+monkey() { echo "$FAKE_ADB_SERIAL monkey $*" >> "$FAKE_ADB_LOG"; echo "Events injected: 1"; }
+screencap() {
+    png=""
+    [ "$1" = "-p" ] && png=1 && shift
+    if [ -n "$1" ]; then mkdir -p "$FAKE_ADB_ROOT$(dirname "$1")"; cp "$FAKE_ADB_SCREEN" "$FAKE_ADB_ROOT$1";
+    elif [ -n "$png" ]; then cat "$FAKE_ADB_SCREEN";
+    else cat "$FAKE_ADB_SCREEN_RAW"; fi
+}
+uiautomator() {
+    f="${2:-/sdcard/window_dump.xml}"
+    if [ "$f" = "/dev/tty" ] || [ "$f" = "/dev/stdout" ]; then cat "$FAKE_ADB_XML";
+    else mkdir -p "$FAKE_ADB_ROOT$(dirname "$f")"; cp "$FAKE_ADB_XML" "$FAKE_ADB_ROOT$f"; fi
+    echo "UI hierchary dumped to: $f"
+}
+"""
+
+
+def make_png(width, height, rgb=(255, 255, 255)):
+    row = b"\x00" + bytes(rgb) * width
+    raw = zlib.compress(row * height)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+def make_raw(png_path):
+    import cv2
+
+    image = cv2.imread(png_path, cv2.IMREAD_COLOR)
+    height, width, _ = image.shape
+    rgba = cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
+    # Android 9+ header: width, height, pixel format (RGBA_8888) and color space (sRGB).
+    return struct.pack("<4I", width, height, 1, 1) + rgba.tobytes()
+
+
+def make_xml(width, height):
+    nodes = []
+    rows = 8
+    for i in range(rows):
+        top, bottom = height * i // rows, height * (i + 1) // rows
+        nodes.append(f'<node index="{i}" text="Item {i}" resource-id="com.fake:id/item" class="android.widget.Button" '
+                     f'content-desc="" clickable="true" focusable="true" long-clickable="false" scrollable="false" '
+                     f'bounds="[0,{top}][{width},{bottom}]" />')
+    return (f"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">"
+            f'<node index="0" text="" resource-id="com.fake:id/list" class="android.widget.LinearLayout" '
+            f'content-desc="" clickable="false" focusable="false" long-clickable="false" scrollable="true" '
+            f'bounds="[0,0][{width},{height}]">{"".join(nodes)}</node></hierarchy>')
+
+
+def prepare_env(serial):
+    os.makedirs(ROOT, exist_ok=True)
+    width, height = map(int, SIZE.split("x"))
+    screen = os.environ.get("FAKE_ADB_SCREEN")
+    if not screen:
+        screen = os.path.join(ROOT, f"screen_{SIZE}.png")
+        if not os.path.exists(screen):
+            with open(screen, "wb") as f:
+                f.write(make_png(width, height))
+    screen_raw = os.path.join(ROOT, os.path.splitext(os.path.basename(screen))[0] + ".raw")
+    if not os.path.exists(screen_raw) or os.path.getmtime(screen_raw) < os.path.getmtime(screen):
+        with open(screen_raw, "wb") as f:
+            f.write(make_raw(screen))
+    xml = os.environ.get("FAKE_ADB_XML")
+    if not xml:
+        xml = os.path.join(ROOT, f"window_dump_{SIZE}.xml")
+        if not os.path.exists(xml):
+            with open(xml, "w") as f:
+                f.write(make_xml(width, height))
+    env = dict(os.environ)
+    env.update({"FAKE_ADB_ROOT": ROOT, "FAKE_ADB_SIZE": SIZE, "FAKE_ADB_SCREEN": screen,
+                "FAKE_ADB_SCREEN_RAW": screen_raw, "FAKE_ADB_XML": xml,
+                "FAKE_ADB_LOG": LOG, "FAKE_ADB_SERIAL": serial})
+    return env
+
+
+def shell(serial, args):
+    env = prepare_env(serial)
+    if args:
+        return subprocess.call(["sh", "-c", PRELUDE + " ".join(args)], env=env)
+    # Interactive session: load the fakes once, then forward our stdin line by line.
+    proc = subprocess.Popen(["sh"], stdin=subprocess.PIPE, env=env)
+    proc.stdin.write(PRELUDE.encode())
+    proc.stdin.flush()
+    try:
+        for line in iter(sys.stdin.buffer.readline, b""):
+            proc.stdin.write(line)
+            proc.stdin.flush()
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    return proc.wait()
+
+
+def main(argv):
+    serial = DEVICES[0]
+    if argv[:1] == ["-s"]:
+        serial = argv[1]
+        argv = argv[2:]
+        if serial not in DEVICES:
+            print(f"adb: device '{serial}' not found", file=sys.stderr)
+            return 1
+    if not argv:
+        print("adb: no command", file=sys.stderr)
+        return 1
+    if argv[0] == "devices":
+        print("List of devices attached")
+        for d in DEVICES:
+            print(f"{d}\tdevice")
+        return 0
+    if argv[0] in ("shell", "exec-out"):
+        return shell(serial, argv[1:])
+    if argv[0] == "pull":
+        prepare_env(serial)
+        src, dst = argv[1], argv[2]
+        if not os.path.exists(ROOT + src):
+            print(f"adb: error: failed to stat remote object '{src}': No such file or directory", file=sys.stderr)
+            return 1
+        shutil.copy(ROOT + src, dst)
+        print(f"{src}: 1 file pulled.")
+        return 0
+    print(f"adb: unknown command {argv[0]}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,37 +1,165 @@
+import asyncio
+import email.utils
+import random
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from config import load_config
+from rate_limiter import get_rate_limiter
+from response_cache import get_response_cache
+from tracing import span
+from usage import request_cost
 from utils import print_with_color
 
 configs = load_config()
 
+# A rough upper bound of what one screenshot costs, used to reserve rate-limit budget before the real usage is known.
+IMAGE_TOKENS_ESTIMATE = 1105
+
+
+def estimate_tokens(content):
+    if isinstance(content, str):
+        return len(content) // 4
+    tokens = 0
+    for part in content:
+        if part["type"] == "text":
+            tokens += len(part["text"]) // 4
+        else:
+            tokens += IMAGE_TOKENS_ESTIMATE
+    return tokens
+
+
+class ModelClient:
+    """A client for the chat completions API that keeps its HTTPS connections alive across requests.
+
+    Every request first waits for the rate limiter shared by its API base and model. Requests that fail with 429 or
+    5xx, time out or lose their connection are retried with exponential backoff, honoring the Retry-After header when
+    the server sends one. The client is thread-safe, and `ask_async` lets several asyncio agents share one client and
+    its connection pool.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_base=None, api_key=None, model=None, timeout=None, max_retries=None, backoff=None,
+                 pool_size=16):
+        self.api_base = api_base or configs["OPENAI_API_BASE"]
+        self.api_key = api_key or configs["OPENAI_API_KEY"]
+        self.model = model or configs["OPENAI_API_MODEL"]
+        self.timeout = timeout or configs["REQUEST_TIMEOUT"]
+        self.max_retries = configs["MAX_RETRIES"] if max_retries is None else max_retries
+        self.backoff = configs["RETRY_BACKOFF"] if backoff is None else backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        })
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="model-client")
+        self.limiter = get_rate_limiter(self.api_base, self.model)
+
+    def retry_delay(self, attempt, response=None):
+        if response is not None and "Retry-After" in response.headers:
+            retry_after = response.headers["Retry-After"]
+            try:
+                return max(float(retry_after), 0)
+            except ValueError:
+                pass
+            try:
+                date = email.utils.parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                # Neither a number of seconds nor an HTTP date: fall back to the exponential backoff.
+                date = None
+            if date is not None:
+                return max(date.timestamp() - time.time(), 0)
+        return self.backoff * 2 ** attempt * (1 + random.random() / 4)
+
+    def ask(self, content):
+        payload = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ],
+            "temperature": configs["TEMPERATURE"],
+            "max_tokens": configs["MAX_TOKENS"]
+        }
+        estimate = estimate_tokens(content) + configs["MAX_TOKENS"]
+        attempt = 0
+        while True:
+            response = None
+            self.limiter.acquire(estimate)
+            try:
+                response = self.session.post(self.api_base, json=payload, timeout=self.timeout)
+                self.limiter.update(response.headers)
+                if response.status_code not in self.retry_statuses:
+                    try:
+                        rsp = response.json()
+                    except ValueError:
+                        return {"error": {"message": f"Invalid response from the model API (HTTP "
+                                                     f"{response.status_code}): {response.text[:200]}"}}
+                    if not isinstance(rsp, dict):
+                        return {"error": {"message": f"Unexpected response from the model API: {rsp}"}}
+                    if response.status_code != 200 and "error" not in rsp:
+                        rsp["error"] = {"message": f"HTTP {response.status_code}"}
+                    if "usage" in rsp:
+                        self.limiter.correct(rsp["usage"].get("total_tokens", estimate) - estimate)
+                    return rsp
+                error = f"HTTP {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            if attempt >= self.max_retries:
+                return {"error": {"message": f"Model request failed after {attempt + 1} attempts: {error}"}}
+            delay = self.retry_delay(attempt, response)
+            print_with_color(f"Model request failed ({error}), retrying in {delay:.1f}s", "yellow")
+            time.sleep(delay)
+            attempt += 1
+
+    async def ask_async(self, content):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.ask, content)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ModelClient()
+        return _client
+
 
-def ask_gpt4v(content):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {configs['OPENAI_API_KEY']}"
-    }
-    payload = {
-        "model": configs["OPENAI_API_MODEL"],
-        "messages": [
-            {
-                "role": "user",
-                "content": content
-            }
-        ],
-        "temperature": configs["TEMPERATURE"],
-        "max_tokens": configs["MAX_TOKENS"]
-    }
-    response = requests.post(configs["OPENAI_API_BASE"], headers=headers, json=payload)
-    if "error" not in response.json():
-        usage = response.json()["usage"]
-        prompt_tokens = usage["prompt_tokens"]
-        completion_tokens = usage["completion_tokens"]
-        print_with_color(f"Request cost is "
-                         f"${'{0:.2f}'.format(prompt_tokens / 1000 * 0.01 + completion_tokens / 1000 * 0.03)}",
-                         "yellow")
-    return response.json()
+def ask_gpt4v(content, client=None):
+    client = client or get_client()
+    cache = get_response_cache()
+    if cache is not None:
+        key = cache.key(client.model, content)
+        rsp = cache.get(key)
+        if rsp is not None:
+            print_with_color("Response served from the cache", "yellow")
+            return dict(rsp, cached=True)
+    with span("model.ask"):
+        rsp = client.ask(content)
+    if "error" not in rsp:
+        cost = request_cost(rsp["usage"], client.model)
+        print_with_color(f"Request cost is ${'{0:.2f}'.format(cost)}", "yellow")
+        if cache is not None:
+            cache.put(key, rsp, cost)
+    return rsp
 
 
 def parse_explore_rsp(rsp):
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from agent import PERCEPTION_FAILED, Agent, find_docs_dir, print_cache_stats
+from and_controller import list_all_devices, AndroidController
+from config import load_config
+from model import get_client
+from response_cache import get_response_cache
+from utils import print_with_color
+
+configs = load_config()
+
+
+class MultiDeviceRunner:
+    """Runs a queue of tasks across a pool of devices from one process.
+
+    Each device gets its own AndroidController and worker thread that takes the next task off the shared queue, while
+    all workers share one model client and therefore one connection pool and rate limiter. Every finished task is
+    appended to the per-device log `<log_dir>/<device>.jsonl` and, if given, to the shared results file. A device whose
+    screen could not be read for DEVICE_MAX_FAILURES tasks in a row is left out of the rest of the run, so that it does
+    not fail the remaining tasks one after another.
+
+    A task is a dict with the keys "app" and "task" and, optionally, "docs" ("auto", "demo" or "none"), "max_rounds",
+    "package" (the app is force-stopped and relaunched before the task when set) and "id" (copied to the result).
+    """
+
+    def __init__(self, devices, root_dir="./", client=None, controller_factory=AndroidController, log_dir=None,
+                 results_path=None):
+        self.devices = devices
+        self.root_dir = root_dir
+        self.client = client or get_client()
+        self.controller_factory = controller_factory
+        self.log_dir = log_dir or os.path.join(root_dir, "tasks", "devices")
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.results_path = results_path
+        self.lock = threading.Lock()
+        self.results = []
+
+    def run(self, tasks):
+        task_queue = queue.Queue()
+        for task in tasks:
+            task_queue.put(task)
+        self.results = []
+        start_time = time.time()
+        workers = [threading.Thread(target=self.work, args=(device, task_queue), name=f"device-{device}")
+                   for device in self.devices]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.results, self.summarize(time.time() - start_time)
+
+    def run_task(self, agents, controller, task):
+        app = task["app"]
+        key = (app, task.get("docs"))
+        if key not in agents:
+            app_dir = os.path.join(self.root_dir, "apps", app)
+            agents[key] = Agent(app, controller, find_docs_dir(app_dir, task.get("docs")), self.root_dir,
+                                self.client)
+        if task.get("package") and controller.reset_app(task["package"]) == "ERROR":
+            print_with_color(f"ERROR: failed to reset the app {task['package']}", "red")
+            return {"task": task["task"], "success": False, "status": "error", "rounds": 0,
+                    "error": "failed to reset the app"}
+        return agents[key].run(task["task"], task.get("max_rounds"))
+
+    def work(self, device, task_queue):
+        controller = self.controller_factory(device)
+        if not controller.width and not controller.height:
+            print_with_color(f"ERROR: Invalid device size of {device}, the device is left out", "red")
+            return
+        log_path = os.path.join(self.log_dir, device.replace(":", "_") + ".jsonl")
+        agents = {}
+        failures = 0
+        while True:
+            try:
+                task = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            print_with_color(f"[{device}] Starting task: {task['task']}", "yellow")
+            try:
+                result = self.run_task(agents, controller, task)
+            except Exception as e:
+                print_with_color(f"ERROR: [{device}] an exception occurs while running the task: {e}", "red")
+                result = {"task": task["task"], "success": False, "status": "error", "rounds": 0, "error": str(e)}
+            result.update({"app": task["app"], "device": device, "finished_at": time.time()})
+            if "id" in task:
+                result["id"] = task["id"]
+            with self.lock:
+                self.results.append(result)
+                with open(log_path, "a") as logfile:
+                    logfile.write(json.dumps(result) + "\n")
+                if self.results_path:
+                    with open(self.results_path, "a") as results_file:
+                        results_file.write(json.dumps(result) + "\n")
+            failures = failures + 1 if result.get("error") == PERCEPTION_FAILED else 0
+            if failures >= configs["DEVICE_MAX_FAILURES"]:
+                print_with_color(f"ERROR: the screen of {device} could not be read for {failures} tasks in a row, the "
+                                 f"device is left out of the rest of the run", "red")
+                break
+        controller.close()
+
+    def summarize(self, elapsed):
+        devices = {}
+        for result in self.results:
+            device_stats = devices.setdefault(result["device"], {"tasks": 0, "success": 0, "rounds": 0, "busy": 0})
+            device_stats["tasks"] += 1
+            device_stats["success"] += int(result["success"])
+            device_stats["rounds"] += result["rounds"]
+            device_stats["busy"] += result.get("elapsed", 0)
+        stats = {"tasks": len(self.results), "success": sum(int(r["success"]) for r in self.results),
+                 "rounds": sum(r["rounds"] for r in self.results),
+                 "cost": round(sum(r.get("cost", 0) for r in self.results), 4), "elapsed": round(elapsed, 3),
+                 "tasks_per_hour": round(len(self.results) * 3600 / elapsed, 2) if elapsed else 0,
+                 "devices": devices}
+        cache = get_response_cache()
+        if cache is not None:
+            stats["cache"] = cache.stats()
+        return stats
+
+
+def print_summary(stats):
+    print_with_color(f"{stats['tasks']} tasks finished in {stats['elapsed']:.0f}s, {stats['success']} completed "
+                     f"successfully, {stats['rounds']} rounds in total, {stats['tasks_per_hour']} tasks per hour, "
+                     f"${stats['cost']:.2f} spent", "yellow")
+    for device, device_stats in stats["devices"].items():
+        print_with_color(f"{device}: {device_stats['tasks']} tasks, {device_stats['success']} completed, "
+                         f"{device_stats['rounds']} rounds, busy for {device_stats['busy']:.0f}s", "yellow")
+    if "cache" in stats:
+        print_cache_stats(stats["cache"])
+
+
+if __name__ == "__main__":
+    arg_desc = "AppAgent - Multi-device Executor"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("--app", required=True)
+    parser.add_argument("--tasks", required=True, help="a text file with one task description per line")
+    parser.add_argument("--devices", help="comma-separated device IDs, all attached devices by default")
+    parser.add_argument("--docs", choices=["auto", "demo", "none"])
+    parser.add_argument("--root_dir", default="./")
+    args = vars(parser.parse_args())
+
+    device_list = args["devices"].split(",") if args["devices"] else list_all_devices()
+    if not device_list:
+        print_with_color("ERROR: No device found!", "red")
+        sys.exit()
+    with open(args["tasks"], "r") as f:
+        task_list = [{"app": args["app"], "task": line.strip(), "docs": args["docs"]} for line in f if line.strip()]
+    print_with_color(f"Running {len(task_list)} tasks on {len(device_list)} devices: {device_list}", "yellow")
+    runner = MultiDeviceRunner(device_list, args["root_dir"])
+    _, run_stats = runner.run(task_list)
+    print_summary(run_stats)
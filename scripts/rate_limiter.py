@@ -0,0 +1,115 @@
+import re
+import threading
+import time
+
+from config import load_config
+
+configs = load_config()
+
+
+class TokenBucket:
+    """A bucket refilled continuously at `per_minute / 60` units per second, holding at most `per_minute` units.
+
+    Callers reserve what they need up front and the bucket may go into debt, so each caller is told exactly how long
+    to wait and concurrent callers are served in order without polling. A budget of 0 means unlimited.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.per_minute:
+            self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self.refill(now)
+        if not self.per_minute:
+            return 0
+        self.level -= min(amount, self.per_minute)
+        return max(0, -self.level * 60 / self.per_minute)
+
+    def set_limit(self, per_minute, now):
+        self.refill(now)
+        if not self.per_minute:
+            self.level = per_minute
+        self.per_minute = per_minute
+
+    def set_remaining(self, remaining, reset_seconds, now):
+        """Trust the server's view of the bucket when it is emptier than ours."""
+        self.refill(now)
+        if remaining < self.level:
+            self.level = remaining
+        if remaining <= 0 and reset_seconds and self.per_minute:
+            self.level = min(self.level, -reset_seconds * self.per_minute / 60)
+
+
+def parse_reset(value):
+    """Parse a rate-limit reset duration such as "20ms", "1s" or "6m0s" into seconds."""
+    seconds = 0
+    for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets of one API base and model.
+
+    The budgets start from REQUESTS_PER_MINUTE and TOKENS_PER_MINUTE and are kept in sync with the x-ratelimit-*
+    headers of every response, so a caller only blocks when the quota would otherwise be exceeded.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.lock = threading.Lock()
+        self.waited = 0
+
+    def reserve(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now))
+            self.waited += wait
+            return wait
+
+    def acquire(self, tokens=0):
+        """Block until a request estimated to use `tokens` tokens fits into the budgets."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def correct(self, tokens):
+        """Account for the difference between the estimated and the actual tokens of a finished request."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens.refill(now)
+            if self.tokens.per_minute:
+                self.tokens.level -= tokens
+
+    def update(self, headers):
+        with self.lock:
+            now = time.monotonic()
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit and limit.isdigit():
+                    bucket.set_limit(int(limit), now)
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining and remaining.isdigit():
+                    bucket.set_remaining(int(remaining), parse_reset(headers.get(f"x-ratelimit-reset-{kind}", "")),
+                                         now)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_base, model):
+    """Return the limiter shared by every client that talks to the same API base and model."""
+    with _limiters_lock:
+        key = (api_base, model)
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(configs["REQUESTS_PER_MINUTE"], configs["TOKENS_PER_MINUTE"])
+        return _limiters[key]
@@ -0,0 +1,192 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+import time
+
+from agent import make_run_dir
+from and_controller import connect_device, extract_elements
+from screen_graph import perform_action, screen_signature
+from utils import print_with_color
+
+
+def parse_record_line(line):
+    """Turn a line of a demo's record.txt, such as `swipe(3:sep:up):::<uid>`, into an action."""
+    match = re.match(r"(\w+)\((.*)\):::(.*)$", line)
+    if match is None:
+        return None
+    name, params, uid = match.groups()
+    params = params.split(":sep:")
+    if name == "tap" or name == "long_press":
+        return {"name": name, "uid": uid, "args": []}
+    if name == "text":
+        return {"name": "text", "args": [params[1][1:-1]]}
+    if name == "swipe":
+        return {"name": "swipe", "uid": uid, "args": [params[1], "medium"]}
+    return None
+
+
+def load_demo(demo_dir):
+    """Load the trace of a recorded demo: the actions of its record.txt with the fingerprint of the screen each was
+    recorded on, taken from the demo's saved hierarchies. Returns the steps and the fingerprint of the final screen, or
+    None when the demo was not stopped properly."""
+    demo_name = os.path.basename(os.path.normpath(demo_dir))
+    with open(os.path.join(demo_dir, "record.txt"), "r") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    steps = []
+    final_screen = None
+    for i, line in enumerate(lines):
+        xml_path = os.path.join(demo_dir, "xml", f"{demo_name}_{i + 1}.xml")
+        screen = screen_signature(xml_path) if os.path.exists(xml_path) else None
+        if line == "stop":
+            final_screen = screen
+            break
+        action = parse_record_line(line)
+        if action is None:
+            print_with_color(f"ERROR: cannot parse the record line {line}", "red")
+            return None, None
+        steps.append({"step": i + 1, "action": action, "screen": screen})
+    return steps, final_screen
+
+
+def load_task_log(log_path):
+    """Load the trace of a task run by the agent from its log: the steps replayed from a known path and the actions
+    the model chose, with the fingerprint of the screen each was taken on."""
+    steps = []
+    final_screen = None
+    with open(log_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "replayed" in record:
+                steps.extend({"step": 0, "action": hop["action"], "screen": hop["src"]} for hop in record["replayed"])
+            elif "action" in record:
+                if record["action"]["name"] == "FINISH":
+                    final_screen = record["screen"]
+                else:
+                    steps.append(record)
+    if final_screen is None:
+        print_with_color("The task in this log did not complete, its final screen will not be checked", "yellow")
+    return steps, final_screen
+
+
+class Replayer:
+    """Replays recorded traces on one device without the model.
+
+    Every action finds its element by UID in the live hierarchy, and waits for the screen to settle before the next
+    one. With `verify`, the screen before every step, and the final screen, must have the fingerprint recorded with
+    the trace; the replay stops at the first screen that differs.
+    """
+
+    def __init__(self, controller, root_dir="./", verify=True):
+        self.controller = controller
+        self.verify = verify
+        self.work_dir = os.path.join(root_dir, "tasks")
+        if not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+
+    def check_screen(self, ui_tree, expected, step):
+        screen = screen_signature(ui_tree)
+        if self.verify and expected is not None and screen != expected:
+            print_with_color(f"ERROR: the screen before step {step} is not the recorded one", "red")
+            return screen, False
+        return screen, True
+
+    def replay(self, steps, final_screen=None, name="replay"):
+        """Replay the steps of a trace. Returns a summary with the status ("completed", "diverged" or "error"), the
+        number of steps replayed, the step the replay stopped at and the time it took."""
+        controller = self.controller
+        start_time = time.time()
+        dir_name = datetime.datetime.fromtimestamp(int(start_time)).strftime(f"replay_{name}_%Y-%m-%d_%H-%M-%S")
+        task_dir = make_run_dir(self.work_dir, dir_name)
+        dir_name = os.path.basename(task_dir)
+        log_path = os.path.join(task_dir, f"log_{dir_name}.txt")
+
+        status = "completed"
+        failed_step = None
+        replayed = 0
+        ui_tree = controller.dump_hierarchy(f"{dir_name}_0", task_dir)
+        for i, step in enumerate(steps):
+            if ui_tree == "ERROR":
+                status, failed_step = "error", step["step"]
+                break
+            screen, ok = self.check_screen(ui_tree, step["screen"], step["step"])
+            if not ok:
+                ui_tree.save()
+                status, failed_step = "diverged", step["step"]
+                break
+            step_start = time.time()
+            ret = perform_action(controller, step["action"], extract_elements(ui_tree))
+            if ret == "ERROR":
+                status, failed_step = "error", step["step"]
+                break
+            controller.wait_until_settled()
+            replayed += 1
+            with open(log_path, "a") as logfile:
+                logfile.write(json.dumps({"step": step["step"], "action": step["action"], "screen": screen,
+                                          "expected": step["screen"],
+                                          "ms": round((time.time() - step_start) * 1000, 1)}) + "\n")
+            ui_tree = controller.dump_hierarchy(f"{dir_name}_{i + 1}", task_dir)
+        if status == "completed" and final_screen is not None:
+            if ui_tree == "ERROR":
+                status = "error"
+            elif not self.check_screen(ui_tree, final_screen, "the end")[1]:
+                ui_tree.save()
+                status = "diverged"
+
+        elapsed = round(time.time() - start_time, 3)
+        if status == "completed":
+            print_with_color(f"Replay completed: {replayed} steps in {elapsed:.1f}s", "yellow")
+        else:
+            print_with_color(f"Replay {status} after {replayed} of {len(steps)} steps", "red")
+        return {"name": name, "status": status, "steps": len(steps), "replayed": replayed, "failed_step": failed_step,
+                "task_dir": task_dir, "elapsed": elapsed}
+
+
+def main(app=None, demo=None, log=None, device=None, package=None, verify=True, repeat=1, root_dir="./"):
+    """Replay a demo of the app, or a task log, `repeat` times. Returns the summaries of the replays."""
+    if demo:
+        steps, final_screen = load_demo(os.path.join(root_dir, "apps", app, "demos", demo))
+        name = demo
+    else:
+        steps, final_screen = load_task_log(log)
+        name = os.path.basename(os.path.dirname(os.path.abspath(log)))
+    if steps is None:
+        return None
+    controller = connect_device(device)
+    if controller is None:
+        return None
+    replayer = Replayer(controller, root_dir, verify)
+    results = []
+    for _ in range(repeat):
+        if package and controller.reset_app(package) == "ERROR":
+            print_with_color(f"ERROR: failed to restart {package}", "red")
+            break
+        results.append(replayer.replay(steps, final_screen, name))
+    controller.close()
+    return results
+
+
+if __name__ == "__main__":
+    arg_desc = "AppAgent - Replay"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("--app", help="the app of the demo to replay")
+    parser.add_argument("--demo", help="the name of the demo to replay")
+    parser.add_argument("--log", help="the log of a task to replay, instead of a demo")
+    parser.add_argument("--device")
+    parser.add_argument("--package", help="the package of the app, restarted before every replay")
+    parser.add_argument("--no_verify", action="store_true", help="do not check the screens against the recorded ones")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--root_dir", default="./")
+    args = vars(parser.parse_args())
+    if not args["log"] and not (args["app"] and args["demo"]):
+        parser.print_usage()
+        sys.exit(1)
+    summaries = main(args["app"], args["demo"], args["log"], args["device"], args["package"], not args["no_verify"],
+                     args["repeat"], args["root_dir"])
+    if not summaries or any(summary["status"] != "completed" for summary in summaries):
+        sys.exit(1)
@@ -0,0 +1,149 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from config import load_config
+from utils import print_with_color
+
+configs = load_config()
+
+
+# The width of the grid of tiles an image is hashed on, and the gray levels merged into one when tiles are compared.
+IMAGE_HASH_WIDTH = 96
+IMAGE_HASH_LEVEL_SHIFT = 3
+
+
+def image_hash(url):
+    """Hash an image data URL on a grid of IMAGE_HASH_WIDTH tiles across, about 11 pixels wide on a phone screen,
+    with the mean gray level of every tile coarsened to 32 levels. Encoding noise is averaged away, while typed text, a
+    toggled switch, a toast or a small dialog changes the key. URLs that are not data URLs are hashed as they are."""
+    header, _, data = url.partition(",")
+    if not header.startswith("data:image") or not data:
+        return hashlib.sha256(url.encode()).hexdigest()
+    image = cv2.imdecode(np.frombuffer(base64.b64decode(data), np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return hashlib.sha256(data.encode()).hexdigest()
+    height, width = image.shape
+    rows = max(1, round(height * IMAGE_HASH_WIDTH / width))
+    tiles = cv2.resize(image, (IMAGE_HASH_WIDTH, rows), interpolation=cv2.INTER_AREA) >> IMAGE_HASH_LEVEL_SHIFT
+    return hashlib.sha256(np.array(tiles.shape).tobytes() + tiles.tobytes()).hexdigest()
+
+
+class ResponseCache:
+    """An on-disk cache of model responses, keyed on the model, the sampling settings, the prompt text and a tile hash
+    of every image in the request.
+
+    Every response is a JSON file under `cache_dir`. A hit refreshes the file's mtime, and when the cache grows past
+    `max_bytes` the least recently used files are evicted. Entries older than `ttl` seconds are treated as misses and
+    removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_cost = 0.0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.entries = {}
+        for name in os.listdir(cache_dir):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(cache_dir, name))
+                self.entries[name[:-5]] = (stat.st_mtime, stat.st_size)
+        self.size = sum(size for _, size in self.entries.values())
+
+    def key(self, model, content):
+        parts = [model, configs["TEMPERATURE"], configs["MAX_TOKENS"]]
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            for item in content:
+                if item["type"] == "text":
+                    parts.append(item["text"])
+                elif item["type"] == "image_url":
+                    parts.append(image_hash(item["image_url"]["url"]))
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _remove(self, key):
+        _, size = self.entries.pop(key)
+        self.size -= size
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self.path(key), "r") as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                record = None
+            now = time.time()
+            if record is None or self.ttl and now - record["created"] > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return None
+            os.utime(self.path(key), (now, now))
+            self.entries[key] = (now, entry[1])
+            self.hits += 1
+            self.saved_cost += record.get("cost", 0)
+            return record["response"]
+
+    def put(self, key, rsp, cost=0.0):
+        data = json.dumps({"created": time.time(), "cost": cost, "response": rsp})
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            tmp_path = self.path(key) + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+            self.entries[key] = (time.time(), len(data))
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                for old_key, _ in sorted(self.entries.items(), key=lambda item: item[1][0]):
+                    if self.size <= self.max_bytes * 0.9 or old_key == key:
+                        break
+                    self._remove(old_key)
+                    self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+                "evictions": self.evictions, "entries": len(self.entries), "bytes": self.size,
+                "saved_cost": round(self.saved_cost, 4)}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The shared response cache, or None unless RESPONSE_CACHE is on."""
+    global _cache
+    if not configs["RESPONSE_CACHE"]:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(configs["RESPONSE_CACHE_DIR"], configs["RESPONSE_CACHE_SIZE_MB"] * 1024 * 1024,
+                                   configs["RESPONSE_CACHE_TTL_HOURS"] * 3600)
+            print_with_color(f"Response cache enabled with {len(_cache.entries)} cached responses", "yellow")
+        return _cache
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+from and_controller import extract_elements, fingerprints_match, iter_tree
+from config import load_config
+from utils import print_with_color
+
+configs = load_config()
+
+# The actions that target a UI element and can be replayed by resolving its UID in the live hierarchy.
+GRAPH_ACTIONS = ("tap", "long_press", "swipe")
+
+CHANGE_NONE = "none"
+CHANGE_MINOR = "minor"
+CHANGE_NEW_SCREEN = "new_screen"
+# The node attributes that change when the user interacts with a screen without leaving it.
+STATE_ATTRIBS = ("class", "resource-id", "text", "content-desc", "checked", "selected", "focused", "enabled", "bounds")
+# The fraction of frame fingerprint cells that may change, by more than FRAME_CELL_TOLERANCE gray levels, on a screen
+# that did not change, e.g. when the clock in the status bar ticks.
+FRAME_CHANGE_TOLERANCE = 0.005
+FRAME_CELL_TOLERANCE = 8
+
+
+def screen_signature(ui_tree):
+    """Fingerprint a screen by the structure of its hierarchy: the set of the ids of its interactive elements without
+    their sibling indices, so that a screen keeps its fingerprint however many items its lists hold."""
+    uids = sorted(set(extract_elements(ui_tree, add_index=False).uids()))
+    return hashlib.sha1("\n".join(uids).encode()).hexdigest()[:16]
+
+
+def hierarchy_state(ui_tree):
+    """A hash of every node of the hierarchy with its state attributes, which changes with any text, selection,
+    focus or layout change on the screen."""
+    digest = hashlib.sha1()
+    for event, elem in iter_tree(ui_tree):
+        if event == "start":
+            digest.update("|".join(elem.attrib.get(attrib, "") for attrib in STATE_ATTRIBS).encode() + b"\n")
+    return digest.hexdigest()
+
+
+def classify_change(tree_before, tree_after, fp_before=None, fp_after=None):
+    """Classify what an action did from the hierarchies and frame fingerprints before and after it: CHANGE_NEW_SCREEN
+    when the set of interactive elements changed, CHANGE_MINOR when only their state or the pixels changed and
+    CHANGE_NONE when nothing did. Without both fingerprints the pixels are not compared."""
+    if screen_signature(tree_before) != screen_signature(tree_after):
+        return CHANGE_NEW_SCREEN
+    if hierarchy_state(tree_before) != hierarchy_state(tree_after):
+        return CHANGE_MINOR
+    if fp_before is not None and fp_after is not None \
+            and not fingerprints_match(fp_before, fp_after, FRAME_CHANGE_TOLERANCE, FRAME_CELL_TOLERANCE):
+        return CHANGE_MINOR
+    return CHANGE_NONE
+
+
+def action_key(action):
+    return ":".join([action["name"], action["uid"]] + list(action.get("args", ())))
+
+
+def task_key(task_desc):
+    return re.sub(r"\s+", " ", task_desc.strip().lower()).rstrip(".!")
+
+
+def perform_action(controller, action, elem_list):
+    """Perform a recorded action. Actions on an element find it by the action's UID in the live hierarchy, not at the
+    position it was recorded at; grid actions carry their coordinates in "xy". Returns "ERROR" when the element is
+    not on the screen or the action fails."""
+    if action["name"] == "text":
+        return controller.text(action["args"][0])
+    if action["name"] == "swipe_precise":
+        start, end = action["xy"]
+        return controller.swipe_precise(tuple(start), tuple(end))
+    if "xy" in action:
+        x, y = action["xy"]
+    else:
+        index = elem_list.index(action["uid"])
+        if index < 0:
+            print_with_color(f"ERROR: the element {action['uid']} is not on the screen", "red")
+            return "ERROR"
+        x, y = elem_list.center(index)
+    if action["name"] == "tap":
+        return controller.tap(x, y)
+    if action["name"] == "long_press":
+        return controller.long_press(x, y)
+    if action["name"] == "swipe":
+        swipe_dir, dist = action["args"]
+        return controller.swipe(x, y, swipe_dir, dist)
+    print_with_color(f"ERROR: {action['name']} cannot be replayed", "red")
+    return "ERROR"
+
+
+class ScreenGraph:
+    """A map of the screens of an app and the transitions between them, saved as `screen_graph.json` in the app dir.
+
+    Nodes are screen signatures, with the UIDs of the screen's elements as last labeled. An edge is an action on a UID
+    from one screen, counting every screen it has led to; an edge that has only ever led to one screen is deterministic.
+    Routes map a completed task to the screen it started on and the ordered actions of its navigation prefix, the
+    actions before its first text input or grid action, each with the screen it led to. A route is replayed without
+    the model only as long as each of its actions is still deterministic.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.nodes = {}
+        self.edges = {}
+        self.routes = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                self.nodes, self.edges, self.routes = data["nodes"], data["edges"], data["routes"]
+            except (ValueError, KeyError):
+                print_with_color(f"ERROR: the screen graph {path} is corrupted and will be rebuilt", "red")
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def visit(self, screen, uids=None):
+        """Count a visit of a screen, and remember the UIDs of its elements in the order they were labeled."""
+        with self.lock:
+            node = self.nodes.setdefault(screen, {"visits": 0})
+            node["visits"] += 1
+            if uids is not None:
+                node["uids"] = list(uids)
+
+    def add_transition(self, src, action, dst, summary=""):
+        """Record that the action on `src` led to `dst`. Actions that left the screen unchanged are not recorded."""
+        if src == dst:
+            return
+        with self.lock:
+            edge = self.edges.setdefault(src, {}).setdefault(action_key(action), {"action": action, "dst": {}})
+            edge["dst"][dst] = edge["dst"].get(dst, 0) + 1
+            edge["summary"] = summary
+
+    def add_route(self, task_desc, hops):
+        """Record the route of a completed task from its hops, a list of {"src", "action", "dst", "summary"} with a
+        None action for the steps that cannot be replayed. The route keeps the actions of the navigation prefix in
+        order, up to the first step that cannot be replayed or does not start where the one before it ended."""
+        prefix = []
+        for hop in hops:
+            if hop["action"] is None or (prefix and hop["src"] != prefix[-1]["dst"]):
+                break
+            prefix.append(hop)
+        if not prefix:
+            return
+        steps = [{"action": hop["action"], "screen": hop["dst"], "summary": hop.get("summary", "")} for hop in prefix]
+        with self.lock:
+            route = self.routes.setdefault(task_key(task_desc), {"count": 0})
+            route.update(start=prefix[0]["src"], target=prefix[-1]["dst"], hops=len(prefix), steps=steps)
+            route["count"] += 1
+
+    def route(self, task_desc):
+        """The route of a task completed before, or None. Routes saved without their steps cannot be replayed."""
+        with self.lock:
+            route = self.routes.get(task_key(task_desc))
+            return route if route is not None and "steps" in route else None
+
+    def is_deterministic(self, src, action, dst):
+        """Whether the action on `src` has only ever led to `dst`."""
+        with self.lock:
+            edge = self.edges.get(src, {}).get(action_key(action))
+            return edge is not None and list(edge["dst"]) == [dst]
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"nodes": self.nodes, "edges": self.edges, "routes": self.routes})
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def get_screen_graph(app_dir):
+    """Return the screen graph of an app, shared by every agent working on the app in this process, or None unless
+    SCREEN_GRAPH is on."""
+    if not configs["SCREEN_GRAPH"]:
+        return None
+    path = os.path.abspath(os.path.join(app_dir, "screen_graph.json"))
+    with _graphs_lock:
+        if path not in _graphs:
+            _graphs[path] = ScreenGraph(path)
+        return _graphs[path]
@@ -0,0 +1,113 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import bind, span
+from utils import get_grid_layout, print_with_color
+
+
+class Speculator:
+    """Prewarms the next round of an agent while the model decides on the current one.
+
+    From the screen graph, the elements of the current screen whose actions have led somewhere before are ranked by
+    how often they were taken, and the screens they led to are the likely next screens. During the model call, a
+    worker retrieves the docs of the elements of those screens, as the graph last saw them, and builds their doc
+    prompts, along with the doc prompt of the current screen for actions that stay on it, and the grid of the
+    screenshot's resolution. The next round uses a prebuilt doc prompt when its screen has exactly the elements it
+    was built for and the doc base has not changed since.
+
+    Only the graph and the doc base are read; nothing is sent to the device, which only ever acts on the model's
+    decision.
+    """
+
+    def __init__(self, graph, doc_store, build_ui_doc, top_k=3):
+        self.graph = graph
+        self.doc_store = doc_store
+        self.build_ui_doc = build_ui_doc
+        self.top_k = top_k
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="speculation")
+        self.lock = threading.Lock()
+        self.future = None
+        self.predicted = []
+        self.docs = {}
+        self.stats = {"predictions": 0, "predicted_hits": 0, "prewarmed_docs": 0, "doc_lookups": 0, "doc_hits": 0}
+
+    def predict(self, screen, elem_list):
+        """The UIDs of the elements of the current screen most likely to be acted on, with the screen each led to
+        most often, most frequent first."""
+        scores = {}
+        for edge in self.graph.edges.get(screen, {}).values():
+            uid = edge["action"]["uid"]
+            if elem_list.index(uid) < 0:
+                continue
+            count = sum(edge["dst"].values())
+            if uid not in scores or count > scores[uid][0]:
+                scores[uid] = (count, max(edge["dst"], key=edge["dst"].get))
+        ranked = sorted(scores.items(), key=lambda item: -item[1][0])[:self.top_k]
+        return [(uid, dst) for uid, (_, dst) in ranked]
+
+    def start(self, screen, elem_list, ui_doc, width, height):
+        """Predict the next action on the current screen and prewarm its round in the background. `elem_list` and
+        `ui_doc` are None in grid mode."""
+        with self.graph.lock:
+            self.predicted = self.predict(screen, elem_list) if elem_list is not None else []
+            candidates = [(dst, list(self.graph.nodes.get(dst, {}).get("uids", ()))) for _, dst in self.predicted]
+        self.stats["predictions"] += 1 if self.predicted else 0
+        current = {}
+        if elem_list is not None and ui_doc is not None:
+            current[screen] = (tuple(elem_list.uids()), self.doc_store.stamp, ui_doc)
+        self.future = self.pool.submit(bind(self.prewarm), current, candidates, width, height)
+
+    def prewarm(self, docs, candidates, width, height):
+        with span("speculative_prewarm"):
+            get_grid_layout(width, height)
+            prewarmed = 0
+            if self.doc_store is not None:
+                self.doc_store.refresh()
+                for screen, uids in candidates:
+                    if uids and screen not in docs:
+                        docs[screen] = (tuple(uids), self.doc_store.stamp, self.build_ui_doc(uids))
+                        prewarmed += 1
+            with self.lock:
+                self.docs = docs
+                self.stats["prewarmed_docs"] += prewarmed
+
+    def record_action(self, uid):
+        """Count whether the element the model chose to act on was among the predicted ones."""
+        if self.predicted and uid is not None and uid in (predicted for predicted, _ in self.predicted):
+            self.stats["predicted_hits"] += 1
+
+    def ui_doc(self, screen, uids):
+        """The doc prompt prewarmed for this screen and exact list of elements, or None."""
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+        self.stats["doc_lookups"] += 1
+        self.doc_store.refresh()
+        with self.lock:
+            cached = self.docs.get(screen)
+        if cached is None or cached[0] != tuple(uids) or cached[1] != self.doc_store.stamp:
+            return None
+        self.stats["doc_hits"] += 1
+        return cached[2]
+
+    def summary(self):
+        stats = dict(self.stats)
+        stats["prediction_hit_rate"] = round(stats["predicted_hits"] / stats["predictions"], 3) \
+            if stats["predictions"] else 0.0
+        stats["doc_hit_rate"] = round(stats["doc_hits"] / stats["doc_lookups"], 3) if stats["doc_lookups"] else 0.0
+        return stats
+
+    def reset(self):
+        if self.future is not None:
+            self.future.result()
+        self.future = None
+        self.predicted = []
+        self.docs = {}
+        for key in self.stats:
+            self.stats[key] = 0
+
+
+def print_speculation_stats(stats):
+    print_with_color(f"Speculation: {stats['predicted_hits']} of {stats['predictions']} predicted actions taken "
+                     f"({stats['prediction_hit_rate']:.0%}), {stats['doc_hits']} of {stats['doc_lookups']} doc prompts "
+                     f"prewarmed ({stats['doc_hit_rate']:.0%})", "yellow")
@@ -0,0 +1,122 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from utils import print_with_color
+
+_local = threading.local()
+_null_span = contextlib.nullcontext()
+
+
+class Tracer:
+    """Records timed spans of the phases of an agent run.
+
+    A tracer is activated on the thread running the agent loop; `span` and `traced` then record into it, and cost
+    nothing but a thread-local lookup when no tracer is active. Work handed to other threads records into it when
+    wrapped with `bind`. Spans can be flushed to the step log as they complete, summarized as p50/p95 per phase and
+    exported as Chrome trace JSON, which chrome://tracing and Perfetto open.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.flushed = 0
+
+    @contextlib.contextmanager
+    def activate(self):
+        previous = getattr(_local, "tracer", None)
+        _local.tracer = self
+        try:
+            yield self
+        finally:
+            _local.tracer = previous
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.spans.append({"name": name, "start": round((start - self.origin) * 1000, 3),
+                               "ms": round((end - start) * 1000, 3), "tid": threading.get_ident(), "args": args})
+
+    def flush(self, log_path, step):
+        """Append the spans recorded since the last flush to the step log as one {"step", "spans"} record."""
+        spans = self.spans[self.flushed:]
+        self.flushed = len(self.spans)
+        if not spans:
+            return
+        with open(log_path, "a") as logfile:
+            logfile.write(json.dumps({"step": step, "spans": [{key: span[key] for key in ("name", "start", "ms")}
+                                                              for span in spans]}) + "\n")
+
+    def summary(self):
+        durations = {}
+        for span in self.spans:
+            durations.setdefault(span["name"], []).append(span["ms"])
+        return {name: {"count": len(values), "p50": round(float(np.percentile(values, 50)), 3),
+                       "p95": round(float(np.percentile(values, 95)), 3), "total": round(sum(values), 3)}
+                for name, values in durations.items()}
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        lines = [f"{'phase':<28}{'count':>7}{'p50 ms':>11}{'p95 ms':>11}{'total s':>10}"]
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+            lines.append(f"{name:<28}{stats['count']:>7}{stats['p50']:>11.1f}{stats['p95']:>11.1f}"
+                         f"{stats['total'] / 1000:>10.2f}")
+        print_with_color("\n".join(lines), "cyan")
+
+    def export_chrome(self, path):
+        pid = os.getpid()
+        events = [{"name": span["name"], "ph": "X", "ts": round(span["start"] * 1000), "dur": round(span["ms"] * 1000),
+                   "pid": pid, "tid": span["tid"], "args": span["args"]} for span in self.spans]
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def current_tracer():
+    return getattr(_local, "tracer", None)
+
+
+def bind(func):
+    """Wrap a function so that it records into the tracer active on the calling thread wherever it runs."""
+    tracer = getattr(_local, "tracer", None)
+    if tracer is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracer.activate():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def span(name, **args):
+    tracer = getattr(_local, "tracer", None)
+    if tracer is None:
+        return _null_span
+    return tracer.span(name, **args)
+
+
+def traced(name):
+    """Decorator that records every call of the function as a span named `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = getattr(_local, "tracer", None)
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
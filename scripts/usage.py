@@ -0,0 +1,136 @@
+import json
+import math
+import os
+import threading
+
+from config import load_config
+from utils import print_with_color
+
+configs = load_config()
+
+BUDGET_OK = "ok"
+BUDGET_DEGRADE = "degrade"
+BUDGET_EXCEEDED = "exceeded"
+
+_log_lock = threading.Lock()
+
+
+def model_price(model=None):
+    """USD per 1K prompt and completion tokens of the model, looked up in the MODEL_PRICES table of the config."""
+    prices = configs["MODEL_PRICES"]
+    return prices.get(model or configs["OPENAI_API_MODEL"], prices["default"])
+
+
+def request_cost(usage, model=None):
+    prompt_price, completion_price = model_price(model)
+    return usage["prompt_tokens"] / 1000 * prompt_price + usage["completion_tokens"] / 1000 * completion_price
+
+
+def image_tokens(width, height):
+    """Estimate the prompt tokens of an image sent in high detail: the image is fitted into 2048x2048, its shorter
+    side is scaled down to 768, and every 512px tile costs 170 tokens on top of a base of 85."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+class UsageLedger:
+    """Records the tokens and cost of every model call of one task, and checks them against the task's budget.
+
+    Every call is recorded with its step and kind ("act", "reflect" or "doc"), its prompt and completion tokens as
+    reported by the API, and the estimated share of image tokens in the prompt. `finish` appends the task's totals to
+    the usage log of the app, `<app_dir>/usage.jsonl`, which `app_usage` sums up.
+    """
+
+    def __init__(self, model=None, max_cost=None, max_tokens=None, degrade_at=None):
+        self.model = model or configs["OPENAI_API_MODEL"]
+        self.max_cost = configs["TASK_BUDGET"] if max_cost is None else max_cost
+        self.max_tokens = configs["TASK_TOKEN_BUDGET"] if max_tokens is None else max_tokens
+        self.degrade_at = configs["BUDGET_DEGRADE_AT"] if degrade_at is None else degrade_at
+        self.calls = []
+        self.degraded = False
+
+    def record(self, step, kind, rsp, image_sizes=()):
+        """Record a model call. Responses served from the response cache are recorded as free."""
+        if rsp.get("cached"):
+            entry = {"step": step, "kind": kind, "prompt_tokens": 0, "completion_tokens": 0, "image_tokens": 0,
+                     "cost": 0.0, "cached": True}
+        else:
+            usage = rsp["usage"]
+            entry = {"step": step, "kind": kind, "prompt_tokens": usage["prompt_tokens"],
+                     "completion_tokens": usage["completion_tokens"],
+                     "image_tokens": sum(image_tokens(width, height) for width, height in image_sizes),
+                     "cost": round(request_cost(usage, self.model), 6)}
+        self.calls.append(entry)
+        return entry
+
+    def totals(self):
+        totals = {"calls": len(self.calls), "prompt_tokens": 0, "completion_tokens": 0, "image_tokens": 0, "cost": 0.0}
+        for entry in self.calls:
+            for key in ("prompt_tokens", "completion_tokens", "image_tokens", "cost"):
+                totals[key] += entry[key]
+        totals["cost"] = round(totals["cost"], 6)
+        return totals
+
+    def steps(self):
+        steps = {}
+        for entry in self.calls:
+            step = steps.setdefault(entry["step"], {"prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0})
+            step["prompt_tokens"] += entry["prompt_tokens"]
+            step["completion_tokens"] += entry["completion_tokens"]
+            step["cost"] += entry["cost"]
+        return steps
+
+    def budget_used(self):
+        """The largest fraction of the cost and token budgets used so far, 0 when no budget is set."""
+        totals = self.totals()
+        used = 0.0
+        if self.max_cost:
+            used = max(used, totals["cost"] / self.max_cost)
+        if self.max_tokens:
+            used = max(used, (totals["prompt_tokens"] + totals["completion_tokens"]) / self.max_tokens)
+        return used
+
+    def check_budget(self):
+        used = self.budget_used()
+        if used >= 1:
+            print_with_color(f"ERROR: The task has used up its budget: {self.totals()['cost']:.4f} USD spent", "red")
+            return BUDGET_EXCEEDED
+        if self.degrade_at and used >= self.degrade_at:
+            if not self.degraded:
+                self.degraded = True
+                print_with_color(f"{used:.0%} of the task budget has been used, switching to smaller screenshots and "
+                                 f"no docs", "yellow")
+            return BUDGET_DEGRADE
+        return BUDGET_OK
+
+    def finish(self, app_dir, record):
+        """Append the totals of the task, together with the given fields, to the usage log of the app."""
+        if not os.path.exists(app_dir):
+            os.makedirs(app_dir)
+        entry = dict(record, model=self.model, **self.totals())
+        with _log_lock:
+            with open(os.path.join(app_dir, "usage.jsonl"), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry
+
+
+def app_usage(app_dir):
+    """Sum up the usage log of an app."""
+    totals = {"tasks": 0, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "image_tokens": 0, "cost": 0.0}
+    path = os.path.join(app_dir, "usage.jsonl")
+    if not os.path.exists(path):
+        return totals
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            totals["tasks"] += 1
+            for key in ("calls", "prompt_tokens", "completion_tokens", "image_tokens", "cost"):
+                totals[key] += entry.get(key, 0)
+    totals["cost"] = round(totals["cost"], 6)
+    return totals
@@ -1,9 +1,19 @@
 import base64
+import time
+
 import cv2
-import pyshine as ps
+import numpy as np
 
 from colorama import Fore, Style
 
+LABEL_FONT = cv2.FONT_HERSHEY_DUPLEX
+# The space between the text of a numeric tag and the border of its box.
+LABEL_SPACE = 10
+LABEL_ALPHA = 0.5
+
+# Rendered numeric tags, keyed on the label and its background and text colors.
+_label_sprites = {}
+
 
 def print_with_color(text: str, color=""):
     if color == "red":
@@ -27,72 +37,218 @@ def print_with_color(text: str, color=""):
     print(Style.RESET_ALL)
 
 
-def draw_bbox_multi(img_path, output_path, elem_list, record_mode=False, dark_mode=False):
-    imgcv = cv2.imread(img_path)
-    count = 1
+def load_image(img):
+    """Return a copy of an in-memory BGR image, or read it from disk when a path is given."""
+    if isinstance(img, np.ndarray):
+        return img.copy()
+    return cv2.imread(img)
+
+
+def element_labels(elem_list, scale=1.0):
+    """Return the (center, attrib) pair of every element, reading an ElementTable's columns directly."""
+    if hasattr(elem_list, "centers"):
+        centers = elem_list.centers()
+        if scale != 1.0:
+            centers = (centers * scale).astype(int)
+        return zip(centers.tolist(), elem_list.attribs())
+    labels = []
     for elem in elem_list:
-        try:
-            top_left = elem.bbox[0]
-            bottom_right = elem.bbox[1]
-            left, top = top_left[0], top_left[1]
-            right, bottom = bottom_right[0], bottom_right[1]
-            label = str(count)
-            if record_mode:
-                if elem.attrib == "clickable":
-                    color = (250, 0, 0)
-                elif elem.attrib == "focusable":
-                    color = (0, 0, 250)
-                else:
-                    color = (0, 250, 0)
-                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10, text_offset_y=(top + bottom) // 2 + 10,
-                                    vspace=10, hspace=10, font_scale=1, thickness=2, background_RGB=color,
-                                    text_RGB=(255, 250, 250), alpha=0.5)
+        center = (elem.bbox[0][0] + elem.bbox[1][0]) // 2, (elem.bbox[0][1] + elem.bbox[1][1]) // 2
+        labels.append(((int(center[0] * scale), int(center[1] * scale)), elem.attrib))
+    return labels
+
+
+def label_sprite(label, bg_color, text_color):
+    """Render a numeric tag once: the background block of its box, the bounds of its text in the box, and its text
+    as the per-pixel weights of what is under the text and the weighted text color, from the antialiased coverage of
+    putText. Colors are given as RGB."""
+    key = (label, bg_color, text_color)
+    sprite = _label_sprites.get(key)
+    if sprite is None:
+        (text_w, text_h), _ = cv2.getTextSize(label, LABEL_FONT, fontScale=1, thickness=2)
+        block = np.empty((text_h + 2 * LABEL_SPACE, text_w + 2 * LABEL_SPACE, 3), np.uint8)
+        block[:] = bg_color[::-1]
+        cover = np.zeros(block.shape[:2], np.uint8)
+        cv2.putText(cover, label, (LABEL_SPACE, LABEL_SPACE + text_h), LABEL_FONT, fontScale=1, color=255, thickness=2)
+        ys, xs = np.nonzero(cover)
+        text_box = int(ys.min()), int(ys.max()) + 1, int(xs.min()), int(xs.max()) + 1
+        cover = cover[text_box[0]:text_box[1], text_box[2]:text_box[3]]
+        text_weight = np.repeat(cover[:, :, None].astype(np.float32) / 255, 3, axis=2)
+        sprite = (block, text_box, 1 - text_weight, text_weight * np.array(text_color[::-1], np.float32))
+        _label_sprites[key] = sprite
+    return sprite
+
+
+def blit_label(image, sprite, x, y, alpha=LABEL_ALPHA):
+    """Draw a numeric tag in place with the top-left corner of its text at (x, y), clipped to the image. The box is
+    blended into the image and the text over the box, like pyshine.putBText did, touching only the box's pixels."""
+    block, (text_y0, text_y1, text_x0, text_x1), under_weight, text = sprite
+    height, width = image.shape[:2]
+    x0, y0 = x - LABEL_SPACE, y - LABEL_SPACE
+    x1, y1 = min(x0 + block.shape[1], width), min(y0 + block.shape[0], height)
+    clip_x0, clip_y0 = max(x0, 0), max(y0, 0)
+    if clip_x0 >= x1 or clip_y0 >= y1:
+        return
+    roi = image[clip_y0:y1, clip_x0:x1]
+    roi[:] = cv2.addWeighted(roi, alpha, block[clip_y0 - y0:y1 - y0, clip_x0 - x0:x1 - x0], 1 - alpha, 0)
+    text_x0, text_y0 = x0 + text_x0, y0 + text_y0
+    clip_x0, clip_y0 = max(text_x0, 0), max(text_y0, 0)
+    x1, y1 = min(x0 + text_x1, width), min(y0 + text_y1, height)
+    if clip_x0 >= x1 or clip_y0 >= y1:
+        return
+    roi = image[clip_y0:y1, clip_x0:x1]
+    rows, cols = slice(clip_y0 - text_y0, y1 - text_y0), slice(clip_x0 - text_x0, x1 - text_x0)
+    roi[:] = cv2.convertScaleAbs(cv2.add(cv2.multiply(roi, under_weight[rows, cols], dtype=cv2.CV_32F),
+                                         text[rows, cols]))
+
+
+def draw_bbox_multi(img_path, output_path, elem_list, record_mode=False, dark_mode=False, scale=1.0):
+    """Label every element with its numeric tag. Pass the scale of an image already downscaled by fit_image so the
+    tags are drawn at their full size on the smaller image and stay legible. The tags are rendered once and reused
+    across screenshots. The labeled image is returned, and written to output_path unless it is None."""
+    imgcv = load_image(img_path)
+    for count, ((center_x, center_y), attrib) in enumerate(element_labels(elem_list, scale), 1):
+        if record_mode:
+            if attrib == "clickable":
+                bg_color = (250, 0, 0)
+            elif attrib == "focusable":
+                bg_color = (0, 0, 250)
             else:
-                text_color = (10, 10, 10) if dark_mode else (255, 250, 250)
-                bg_color = (255, 250, 250) if dark_mode else (10, 10, 10)
-                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10, text_offset_y=(top + bottom) // 2 + 10,
-                                    vspace=10, hspace=10, font_scale=1, thickness=2, background_RGB=bg_color,
-                                    text_RGB=text_color, alpha=0.5)
-        except Exception as e:
-            print_with_color(f"ERROR: An exception occurs while labeling the image\n{e}", "red")
-        count += 1
-    cv2.imwrite(output_path, imgcv)
+                bg_color = (0, 250, 0)
+            text_color = (255, 250, 250)
+        else:
+            text_color = (10, 10, 10) if dark_mode else (255, 250, 250)
+            bg_color = (255, 250, 250) if dark_mode else (10, 10, 10)
+        blit_label(imgcv, label_sprite(str(count), bg_color, text_color), center_x + 10, center_y + 10)
+    if output_path is not None:
+        cv2.imwrite(output_path, imgcv)
     return imgcv
 
 
-def draw_grid(img_path, output_path):
-    def get_unit_len(n):
-        for i in range(1, n + 1):
-            if n % i == 0 and 120 <= i <= 180:
-                return i
-        return -1
-
-    image = cv2.imread(img_path)
-    height, width, _ = image.shape
-    color = (255, 116, 113)
-    unit_height = get_unit_len(height)
-    if unit_height < 0:
-        unit_height = 120
-    unit_width = get_unit_len(width)
-    if unit_width < 0:
-        unit_width = 120
-    thick = int(unit_width // 50)
-    rows = height // unit_height
-    cols = width // unit_width
-    for i in range(rows):
-        for j in range(cols):
-            label = i * cols + j + 1
-            left = int(j * unit_width)
-            top = int(i * unit_height)
-            right = int((j + 1) * unit_width)
-            bottom = int((i + 1) * unit_height)
-            cv2.rectangle(image, (left, top), (right, bottom), color, thick // 2)
-            cv2.putText(image, str(label), (left + int(unit_width * 0.05) + 3, top + int(unit_height * 0.3) + 3), 0,
-                        int(0.01 * unit_width), (0, 0, 0), thick)
-            cv2.putText(image, str(label), (left + int(unit_width * 0.05), top + int(unit_height * 0.3)), 0,
-                        int(0.01 * unit_width), color, thick)
-    cv2.imwrite(output_path, image)
-    return rows, cols
+GRID_COLOR = (255, 116, 113)
+SUBAREAS = ("top-left", "top", "top-right", "left", "center", "right", "bottom-left", "bottom", "bottom-right")
+
+# Grid layouts keyed on the screenshot resolution.
+_grid_layouts = {}
+
+
+def grid_unit_len(n):
+    """The smallest divisor of n between 120 and 180, or 120 if there is none."""
+    return next((i for i in range(120, 181) if n % i == 0), 120)
+
+
+class GridLayout:
+    """The grid laid over screenshots of one resolution in grid mode.
+
+    The cell geometry and the point of every subarea of every cell are computed once, and the grid lines and labels
+    are rendered once into `color` and `mask`. Drawing the grid on a screenshot is then a single masked copy of the
+    rendered grid. The mask is opaque wherever the grid covers more than half a pixel, so labels are not antialiased.
+    """
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.unit_width, self.unit_height = grid_unit_len(width), grid_unit_len(height)
+        self.rows, self.cols = height // self.unit_height, width // self.unit_width
+        # Tap points use the cell size of the whole screen divided evenly, as area_to_xy always did.
+        cell_w, cell_h = width // self.cols, height // self.rows
+        cols, rows = np.arange(self.rows * self.cols) % self.cols, np.arange(self.rows * self.cols) // self.cols
+        origins = np.stack((cols * cell_w, rows * cell_h), axis=-1)
+        offsets = np.array([(cell_w * (i % 3 + 1) // 4, cell_h * (i // 3 + 1) // 4) for i in range(len(SUBAREAS))])
+        self.points = origins[:, None, :] + offsets[None, :, :]
+        # The (left, top, right, bottom) of every cell as drawn.
+        self.bounds = np.stack((cols * self.unit_width, rows * self.unit_height, (cols + 1) * self.unit_width,
+                                (rows + 1) * self.unit_height), axis=-1)
+
+        # Rendered on black and on white, a pixel differs by 255 times the share of it the grid leaves uncovered.
+        on_black = self.render(np.zeros((height, width, 3), np.uint8))
+        on_white = self.render(np.full((height, width, 3), 255, np.uint8))
+        coverage = 255 - cv2.absdiff(on_white, on_black).max(axis=2)
+        self.mask = (coverage > 127).astype(np.uint8)
+        # Partially covered pixels were blended with black, their color is recovered by undoing the blend.
+        color = on_black.astype(np.float32) * 255 / np.maximum(coverage, 1)[:, :, None]
+        self.color = np.minimum(color, 255).astype(np.uint8)
+
+    def render(self, image):
+        """Draw the grid lines and labels on an image with OpenCV."""
+        thick = int(self.unit_width // 50)
+        for i in range(self.rows):
+            for j in range(self.cols):
+                label = i * self.cols + j + 1
+                left = int(j * self.unit_width)
+                top = int(i * self.unit_height)
+                right = int((j + 1) * self.unit_width)
+                bottom = int((i + 1) * self.unit_height)
+                cv2.rectangle(image, (left, top), (right, bottom), GRID_COLOR, thick // 2)
+                cv2.putText(image, str(label), (left + int(self.unit_width * 0.05) + 3,
+                                                top + int(self.unit_height * 0.3) + 3), 0,
+                            int(0.01 * self.unit_width), (0, 0, 0), thick)
+                cv2.putText(image, str(label), (left + int(self.unit_width * 0.05), top + int(self.unit_height * 0.3)),
+                            0, int(0.01 * self.unit_width), GRID_COLOR, thick)
+        return image
+
+    def draw(self, image, output_path=None):
+        """Return a copy of the image with the grid composited over it, also written to output_path if given."""
+        labeled = image.copy()
+        cv2.copyTo(self.color, self.mask, labeled)
+        if output_path is not None:
+            cv2.imwrite(output_path, labeled)
+        return labeled
+
+    def point(self, area, subarea):
+        """The point to act on for a subarea of the numbered grid cell. Unknown subareas mean the center."""
+        index = SUBAREAS.index(subarea) if subarea in SUBAREAS else SUBAREAS.index("center")
+        if 1 <= area <= len(self.points):
+            x, y = self.points[area - 1, index]
+            return int(x), int(y)
+        # Areas beyond the grid are extrapolated from the first cell.
+        row, col = (area - 1) // self.cols, (area - 1) % self.cols
+        x, y = self.points[0, index]
+        return int(x + col * (self.width // self.cols)), int(y + row * (self.height // self.rows))
+
+
+def get_grid_layout(width, height):
+    layout = _grid_layouts.get((width, height))
+    if layout is None:
+        layout = _grid_layouts[(width, height)] = GridLayout(width, height)
+    return layout
+
+
+def draw_grid(img_path, output_path, return_image=False):
+    image = img_path if isinstance(img_path, np.ndarray) else load_image(img_path)
+    grid = get_grid_layout(image.shape[1], image.shape[0])
+    image = grid.draw(image, output_path)
+    if return_image:
+        return grid.rows, grid.cols, image
+    return grid.rows, grid.cols
+
+
+def fit_image(image, max_edge):
+    """Downscale an image so that its longer edge is at most max_edge pixels. Returns the image and the scale."""
+    height, width = image.shape[:2]
+    if not max_edge or max(height, width) <= max_edge:
+        return image, 1.0
+    scale = max_edge / max(height, width)
+    return cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA), scale
+
+
+def prepare_image(image, fmt="jpeg", quality=85, grayscale=False):
+    """Encode an in-memory image for upload and return its data URL along with the payload size and encode time."""
+    start = time.perf_counter()
+    if grayscale and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if fmt == "jpeg":
+        ext, params = ".jpg", [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif fmt == "webp":
+        ext, params = ".webp", [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        fmt, ext, params = "png", ".png", []
+    _, buffer = cv2.imencode(ext, image, params)
+    data = base64.b64encode(buffer).decode('utf-8')
+    stats = {"format": fmt, "width": image.shape[1], "height": image.shape[0], "bytes": len(data),
+             "encode_ms": round((time.perf_counter() - start) * 1000, 1)}
+    print_with_color(f"Image payload: {stats['bytes'] / 1024:.0f} KB ({fmt}, {stats['width']}x{stats['height']}), "
+                     f"encoded in {stats['encode_ms']:.0f} ms", "yellow")
+    return f"data:image/{fmt};base64,{data}", stats
 
 
 def encode_image(image_path):
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The scripts import each other as top-level modules and read ./config.yaml, as when they are run from the repo root.
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+os.chdir(ROOT)
+
+
+@pytest.fixture
+def fake_adb(tmp_path, monkeypatch):
+    """Point the controller at scripts/fake_adb.py with a fresh device file system under tmp_path."""
+    import and_controller
+
+    monkeypatch.setenv("FAKE_ADB_ROOT", str(tmp_path / "device"))
+    monkeypatch.setitem(and_controller.configs, "ADB_PATH", f'"{sys.executable}" scripts/fake_adb.py')
+    return tmp_path
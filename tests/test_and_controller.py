@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import and_controller
+from and_controller import AndroidController, fingerprints_match, frame_fingerprint
+
+
+@pytest.fixture(params=[False, True], ids=["one-off", "persistent"])
+def controller(request, fake_adb, monkeypatch):
+    monkeypatch.setitem(and_controller.configs, "ADB_PERSISTENT_SHELL", request.param)
+    controller = AndroidController("emulator-5554")
+    yield controller
+    controller.close()
+
+
+def test_compound_commands_run_on_the_device(controller):
+    # `wm` only exists on the device, so the second one fails if the host shell splits the command at the `&&`.
+    assert controller.shell("wm size && wm size") == "Physical size: 1080x2400\nPhysical size: 1080x2400"
+
+
+def test_dump_hierarchy_without_tty_streams_one_dump(controller, fake_adb, monkeypatch):
+    def no_pull(prefix, save_dir):
+        raise AssertionError("the hierarchy was dumped a second time and pulled")
+
+    monkeypatch.setattr(controller, "get_xml", no_pull)
+    controller.tty_dump = False
+    ui = controller.dump_hierarchy("round_1", str(fake_adb))
+    assert not ui.saved
+    assert len(and_controller.extract_elements(ui)) == 8
+
+
+def test_static_screen_settles(controller):
+    assert controller.wait_until_settled(timeout=2)
+    assert controller.screen_fingerprints
+
+
+def test_fingerprints_tolerate_a_blinking_cursor():
+    screen = np.full((2400, 1080, 3), 255, np.uint8)
+    with_cursor = screen.copy()
+    with_cursor[1000:1060, 500:506] = 0
+    assert fingerprints_match(frame_fingerprint(screen), frame_fingerprint(with_cursor), 0.02)
+    assert not fingerprints_match(frame_fingerprint(screen), frame_fingerprint(np.zeros_like(screen)), 0.02)
+
+
+def test_element_tables_keep_their_own_uids(tmp_path):
+    import fake_adb
+
+    xml_path = tmp_path / "window_dump.xml"
+    xml_path.write_text(fake_adb.make_xml(1080, 2400))
+    first = and_controller.extract_elements(str(xml_path))
+    second = and_controller.extract_elements(str(xml_path), add_index=False)
+    assert first.index(first.uid(3)) == 3
+    assert first.index(second.uid(3)) == -1
+    assert sorted(first.uid_pool) == sorted(first.uids())
+    useless = and_controller.extract_elements(str(xml_path), useless_list=[first.uid(0)])
+    assert useless.uids() == first.uids()[1:]